@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+/***************************************************************************
+                              Docker-OSM Benchmarks
+                    Cost of the scale bands on the statements of a diff.
+ ***************************************************************************/
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import json
+import random
+import sys
+from argparse import ArgumentParser
+from os.path import abspath, dirname, join
+from time import monotonic
+
+from psycopg2 import connect
+from yaml import safe_load
+
+ROOT = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, join(ROOT, 'settings'))
+from materialized_views import generate
+
+SCHEMA = 'docker_osm_benchmark'
+
+
+def create_table(cursor, rows, rng):
+    """osm_admin as imposm writes it in diff mode, filled with random rows."""
+    cursor.execute('CREATE SCHEMA %s' % SCHEMA)
+    cursor.execute(
+        'CREATE TABLE %s.osm_admin (id serial PRIMARY KEY, osm_id bigint, name varchar, '
+        'admin_level integer, geometry geometry(Geometry, 3857))' % SCHEMA)
+    cursor.execute('CREATE INDEX ON %s.osm_admin (osm_id)' % SCHEMA)
+    cursor.executemany(
+        'INSERT INTO %s.osm_admin (osm_id, name, admin_level, geometry) '
+        'VALUES (%%s, %%s, %%s, ST_Buffer(ST_SetSRID(ST_MakePoint(%%s, %%s), 3857), 1000))' % SCHEMA,
+        [(osm_id, 'admin %s' % osm_id, rng.randint(2, 10),
+          rng.uniform(-2e7, 2e7), rng.uniform(-2e7, 2e7)) for osm_id in range(1, rows + 1)])
+    cursor.execute('ANALYZE %s.osm_admin' % SCHEMA)
+
+
+def apply_diff(connection, elements, rows, seed):
+    """Apply a diff as imposm does, a DELETE then an INSERT for every modified element,
+    in one transaction which is rolled back so every run starts from the same rows.
+
+    :return: Wall time in seconds
+    :rtype: float
+    """
+    rng = random.Random(seed)
+    cursor = connection.cursor()
+    start = monotonic()
+    for index in range(elements):
+        osm_id = rng.randint(1, rows)
+        cursor.execute('DELETE FROM %s.osm_admin WHERE osm_id = %%s' % SCHEMA, (osm_id,))
+        cursor.execute(
+            'INSERT INTO %s.osm_admin (osm_id, name, admin_level, geometry) '
+            'VALUES (%%s, %%s, %%s, ST_Buffer(ST_SetSRID(ST_MakePoint(%%s, %%s), 3857), 1000))' % SCHEMA,
+            (osm_id, 'admin %s' % osm_id, rng.randint(2, 10), rng.uniform(-2e7, 2e7), rng.uniform(-2e7, 2e7)))
+    elapsed = monotonic() - start
+    connection.rollback()
+    return elapsed
+
+
+if __name__ == '__main__':
+    arguments = ArgumentParser(
+        description='Time a diff applied to osm_admin with and without its scale bands. '
+                    'Run it on a throwaway PostGIS database.')
+    arguments.add_argument('--dsn', required=True, help='libpq connection string of the database')
+    arguments.add_argument('--rows', type=int, default=100000, help='Number of rows of osm_admin')
+    arguments.add_argument('--elements', type=int, default=5000, help='Number of modified elements of the diff')
+    arguments.add_argument('--seed', type=int, default=0)
+    arguments.add_argument('--output', help='Write the results in this JSON file')
+    options = arguments.parse_args()
+
+    connection = connect(options.dsn)
+    cursor = connection.cursor()
+    cursor.execute(
+        "SELECT count(*) FROM information_schema.schemata WHERE schema_name IN ('materialized_views', %s)",
+        (SCHEMA,))
+    if cursor.fetchone()[0]:
+        sys.exit('The database has a materialized_views or %s schema, use a throwaway database.' % SCHEMA)
+
+    try:
+        create_table(cursor, options.rows, random.Random(options.seed))
+        connection.commit()
+        without_bands = apply_diff(connection, options.elements, options.rows, options.seed)
+
+        with open(join(ROOT, 'settings', 'scale_bands.yml')) as config:
+            scale_bands = safe_load(config)
+        cursor.execute('SELECT current_user')
+        cursor.execute(generate({
+            'schema': SCHEMA,
+            'owner': cursor.fetchone()[0],
+            'cluster': scale_bands.get('cluster', False),
+            'layers': {'osm_admin': scale_bands['layers']['osm_admin']}
+        }))
+        connection.commit()
+        with_bands = apply_diff(connection, options.elements, options.rows, options.seed)
+    finally:
+        connection.rollback()
+        cursor.execute('DROP SCHEMA IF EXISTS materialized_views CASCADE')
+        cursor.execute('DROP SCHEMA IF EXISTS %s CASCADE' % SCHEMA)
+        connection.commit()
+        connection.close()
+
+    results = {
+        'elements': options.elements,
+        'bands': len(scale_bands['layers']['osm_admin']['bands']),
+        'without_bands_seconds': without_bands,
+        'with_bands_seconds': with_bands,
+        'overhead': with_bands / without_bands - 1
+    }
+    print('%s elements : %.2f s without bands, %.2f s with %s bands, %+.0f%%' % (
+        options.elements, without_bands, with_bands, results['bands'], results['overhead'] * 100))
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(results, output, indent=2)
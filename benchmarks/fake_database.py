@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+/***************************************************************************
+                              Docker-OSM Benchmarks
+                    In memory database answering the queries of enrich.
+ ***************************************************************************/
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import re
+
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INTRANS
+
+TABLE_PATTERN = re.compile(r'(?:from|FROM|UPDATE) \w+\."(\w+)"')
+CHECKPOINT_PATTERN = re.compile(r'> (\d+)')
+LIMIT_PATTERN = re.compile(r'LIMIT (\d+)')
+
+
+class FakeDatabase(object):
+    """Tables of osm id and changeset timestamp, counting the round-trips.
+
+    Only the queries sent by enrich are understood: the lookup of osm ids,
+    the scan of the rows without changeset, the batched update and the
+    checks of the schema.
+    """
+
+    def __init__(self, tables):
+        self.tables = tables
+        self.round_trips = 0
+        self.updated_rows = 0
+
+    def connect(self):
+        return FakeConnection(self)
+
+
+class FakeConnection(object):
+
+    encoding = 'UTF8'
+
+    def __init__(self, database):
+        self.database = database
+        self.closed = 0
+        self.status = TRANSACTION_STATUS_IDLE
+
+    def cursor(self, name=None):
+        return FakeCursor(self, name)
+
+    def get_transaction_status(self):
+        return self.status
+
+    def commit(self):
+        self.database.round_trips += 1
+        self.status = TRANSACTION_STATUS_IDLE
+
+    def rollback(self):
+        self.database.round_trips += 1
+        self.status = TRANSACTION_STATUS_IDLE
+
+
+class FakeCursor(object):
+
+    def __init__(self, connection, name):
+        self.connection = connection
+        self.database = connection.database
+        self.name = name
+        self.itersize = 2000
+        self.rows = []
+        self.pending_values = []
+
+    def mogrify(self, template, values):
+        self.pending_values.append(values)
+        return b'()'
+
+    def execute(self, sql, parameters=None):
+        if isinstance(sql, bytes):
+            sql = sql.decode('utf-8')
+        self.connection.status = TRANSACTION_STATUS_INTRANS
+        self.rows = []
+        table = TABLE_PATTERN.search(sql)
+        table = self.database.tables.get(table.group(1), {}) if table else {}
+
+        if sql.startswith('UPDATE'):
+            for values in self.pending_values:
+                if int(values[0]) in table:
+                    table[int(values[0])] = values[3]
+                    self.database.updated_rows += 1
+            self.pending_values = []
+        elif '= ANY(' in sql:
+            self.rows = [
+                (osm_id, table[osm_id]) for osm_id in parameters[0] if osm_id in table]
+        elif 'IS NULL' in sql:
+            if parameters:
+                checkpoint = int(parameters[0])
+            else:
+                checkpoint = CHECKPOINT_PATTERN.search(sql)
+                checkpoint = int(checkpoint.group(1)) if checkpoint else 0
+            self.rows = [
+                (osm_id, None) for osm_id in sorted(table)
+                if table[osm_id] is None and osm_id > checkpoint]
+            limit = LIMIT_PATTERN.search(sql)
+            if limit:
+                self.rows = self.rows[:int(limit.group(1))]
+        else:
+            # checks of the schema
+            self.rows = [(1,)]
+        self.database.round_trips += 1
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+    def __iter__(self):
+        # a server side cursor fetches its rows by itersize
+        for index, row in enumerate(self.rows):
+            if index % self.itersize == 0:
+                self.database.round_trips += 1
+            yield row
+
+
+class FakeConnectionPool(object):
+    """Pool of connections to the fake database, as ThreadedConnectionPool."""
+
+    def __init__(self, database):
+        self.database = database
+        self.closed = False
+
+    def getconn(self):
+        return self.database.connect()
+
+    def putconn(self, connection, close=False):
+        pass
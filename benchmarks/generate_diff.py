@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+/***************************************************************************
+                              Docker-OSM Benchmarks
+                    Synthetic osmChange files for the benchmarks.
+ ***************************************************************************/
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import gzip
+import random
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from xml.sax.saxutils import quoteattr
+
+# Share of each osm type and of each action in a diff.
+DEFAULT_TYPE_MIX = {'node': 0.8, 'way': 0.18, 'relation': 0.02}
+DEFAULT_ACTION_MIX = {'create': 0.3, 'modify': 0.6, 'delete': 0.1}
+
+# Osm ids are drawn from [1, ID_SPACE * share of the type].
+ID_SPACE = 10000000
+
+# Tags of the elements, most of the nodes of a diff are untagged nodes of ways.
+TAGS = {
+    'node': [None, None, None, None, None, None, None,
+             ('amenity', 'cafe'), ('shop', 'bakery'), ('highway', 'bus_stop')],
+    'way': [('highway', 'residential'), ('building', 'house'), ('waterway', 'river'), ('landuse', 'forest')],
+    'relation': [('type', 'multipolygon')]
+}
+
+
+def parse_mix(value):
+    """Parse a mix like node=0.8,way=0.2 into a dictionary."""
+    mix = {}
+    for item in value.split(','):
+        key, share = item.split('=')
+        mix[key.strip()] = float(share)
+    return mix
+
+
+def pick(rng, mix):
+    threshold = rng.random() * sum(mix.values())
+    for key, share in mix.items():
+        threshold -= share
+        if threshold <= 0:
+            return key
+    return key
+
+
+def generate_elements(seed, count, type_mix=None, action_mix=None):
+    """Generate the elements of a diff, deterministic for a seed.
+
+    :return: List of action, osm type, attributes and tags of the element
+    :rtype: list
+    """
+    type_mix = type_mix or DEFAULT_TYPE_MIX
+    action_mix = action_mix or DEFAULT_ACTION_MIX
+    rng = random.Random(seed)
+    start = datetime(2020, 1, 1) + timedelta(minutes=seed)
+    elements = []
+    for index in range(count):
+        osm_type = pick(rng, type_mix)
+        tag = rng.choice(TAGS[osm_type])
+        elements.append((pick(rng, action_mix), osm_type, {
+            'id': str(rng.randint(1, int(ID_SPACE * type_mix[osm_type]))),
+            'version': str(rng.randint(1, 20)),
+            'timestamp': (start + timedelta(seconds=index % 60)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'uid': str(rng.randint(1, 100000)),
+            'user': 'user_%s' % rng.randint(1, 100000),
+            'changeset': str(rng.randint(1, 100000000))
+        }, dict([tag]) if tag else {}))
+    return elements
+
+
+def write_diff(path, elements, compression_level=1):
+    """Write the elements as an osmChange gzip file, grouping consecutive elements of an action."""
+    with gzip.open(path, 'wt', encoding='utf-8', compresslevel=compression_level) as diff:
+        diff.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        diff.write('<osmChange version="0.6" generator="docker-osm benchmarks">\n')
+        action = None
+        for element_action, osm_type, attributes, tags in elements:
+            if element_action != action:
+                if action:
+                    diff.write('  </%s>\n' % action)
+                action = element_action
+                diff.write('  <%s>\n' % action)
+            attributes = ' '.join('%s=%s' % (key, quoteattr(value)) for key, value in attributes.items())
+            if osm_type == 'node':
+                diff.write('    <node %s lat="1.0" lon="1.0">\n' % attributes)
+            else:
+                diff.write('    <%s %s>\n' % (osm_type, attributes))
+            if osm_type == 'way':
+                diff.write('      <nd ref="1"/>\n      <nd ref="2"/>\n')
+            elif osm_type == 'relation':
+                diff.write('      <member type="way" ref="1" role="outer"/>\n')
+            for key, value in tags.items():
+                diff.write('      <tag k=%s v=%s/>\n' % (quoteattr(key), quoteattr(value)))
+            diff.write('    </%s>\n' % osm_type)
+        if action:
+            diff.write('  </%s>\n' % action)
+        diff.write('</osmChange>\n')
+
+
+def diff_file_name(seed):
+    """Name of the diff of a seed, as the downloader names them."""
+    start = datetime(2020, 1, 1) + timedelta(minutes=seed)
+    return '%s->-%s.osc.gz' % (
+        start.strftime('%Y-%m-%dT%H:%M:%SZ'), (start + timedelta(minutes=1)).strftime('%Y-%m-%dT%H:%M:%SZ'))
+
+
+if __name__ == '__main__':
+    arguments = ArgumentParser(description='Generate a synthetic osmChange file.')
+    arguments.add_argument('path', help='Path of the .osc.gz file')
+    arguments.add_argument('--seed', type=int, default=0)
+    arguments.add_argument('--elements', type=int, default=10000)
+    arguments.add_argument('--types', type=parse_mix, default=DEFAULT_TYPE_MIX,
+                           help='Share of each osm type, like node=0.8,way=0.18,relation=0.02')
+    arguments.add_argument('--actions', type=parse_mix, default=DEFAULT_ACTION_MIX,
+                           help='Share of each action, like create=0.3,modify=0.6,delete=0.1')
+    options = arguments.parse_args()
+    write_diff(options.path, generate_elements(options.seed, options.elements, options.types, options.actions))
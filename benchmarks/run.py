@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+/***************************************************************************
+                              Docker-OSM Benchmarks
+                    Benchmarks of the diff import and enrich hot paths.
+ ***************************************************************************/
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import gzip
+import json
+import os
+import platform
+import random
+import resource
+import sys
+from argparse import ArgumentParser, SUPPRESS
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+from os.path import abspath, dirname, join
+from shutil import copy, rmtree
+from subprocess import run, PIPE
+from tempfile import mkdtemp
+from time import monotonic
+
+from fake_database import FakeDatabase, FakeConnectionPool
+from generate_diff import generate_elements, write_diff, diff_file_name
+from stub_osm_api import StubOsmApi
+
+ROOT = dirname(dirname(abspath(__file__)))
+# Modules shared by the services, copied next to each script in the images.
+sys.path.insert(0, join(ROOT, 'common'))
+BENCHMARKS = ('enrich_diff', 'empty_changeset', 'import_diff')
+
+
+class QueueDrained(Exception):
+    pass
+
+
+def create_folders():
+    """Settings, cache, queue and done folders of a throwaway installation."""
+    root = mkdtemp(prefix='docker-osm-benchmark-')
+    folders = {}
+    for folder in ('settings', 'cache', 'import_queue', 'import_done'):
+        folders[folder] = join(root, folder)
+        os.mkdir(folders[folder])
+    # The shipped settings, without the PBF, so the services pick their files as in the images.
+    for f in os.listdir(join(ROOT, 'settings')):
+        if os.path.isfile(join(ROOT, 'settings', f)) and not f.endswith('.pbf'):
+            copy(join(ROOT, 'settings', f), folders['settings'])
+    return root, folders
+
+
+def write_diffs(folder, options):
+    """Write the synthetic diffs, return their elements."""
+    elements = []
+    for seed in range(options.seed, options.seed + options.diffs):
+        diff_elements = generate_elements(seed, options.elements)
+        write_diff(join(folder, diff_file_name(seed)), diff_elements)
+        elements.extend(diff_elements)
+    return elements
+
+
+def create_enrich(folders, options, api_url=''):
+    """Enrich on the throwaway folders, with its metrics but without the HTTP port."""
+    os.environ.update({
+        'SETTINGS': folders['settings'],
+        'CACHE': folders['cache'],
+        'IMPORT_DONE': folders['import_done'],
+        'OSM_API_URL': api_url,
+        'DIFF_WORKERS': str(options.diff_workers),
+        'API_WORKERS': str(options.api_workers),
+        'CACHE_MODIFY_CHECK': 'true',
+        'METRICS_PORT': '0'
+    })
+    sys.path.insert(0, join(ROOT, 'docker-osmenrich'))
+    from enrich import Enrich
+    enrich = Enrich()
+    enrich.start_metrics()
+    return enrich
+
+
+def tables_of_type(enrich, osm_type):
+    return sorted(
+        table for table, table_data in enrich.mapping_database_schema.items()
+        if table_data['osm_type'] == osm_type and table_data['osm_id_columnn'])
+
+
+def benchmark_enrich_diff(folders, options):
+    """Enrich.enrich_database_from_diff_file on the synthetic diffs of import_done."""
+    elements = write_diffs(folders['import_done'], options)
+    enrich = create_enrich(folders, options)
+
+    # A share of the modified elements is in a table their tags can be in, with an older changeset.
+    rng = random.Random(options.seed)
+    tables = {}
+    older = datetime(2019, 1, 1, tzinfo=timezone.utc)
+    for action, osm_type, attributes, tags in elements:
+        osm_tables = sorted(enrich.get_tables_of_osm_data(osm_type, {
+            'tag': [{'@k': key, '@v': value} for key, value in tags.items()]}))
+        if action == 'modify' and osm_tables and rng.random() < options.hit_ratio:
+            tables.setdefault(rng.choice(osm_tables), {})[int(attributes['id'])] = older
+    database = FakeDatabase(tables)
+    enrich.connection_pool = FakeConnectionPool(database)
+
+    start = monotonic()
+    enrich.enrich_database_from_diff_file()
+    wall = monotonic() - start
+    return {
+        'wall_seconds': wall,
+        'elements': enrich.metrics.values.get('docker_osm_enrich_elements_total', 0),
+        'db_round_trips': database.round_trips,
+        'updated_rows': database.updated_rows
+    }
+
+
+def benchmark_empty_changeset(folders, options):
+    """Enrich.process_empty_changeset_from_table against the stub OSM API."""
+    api = StubOsmApi(options.api_latency).start()
+    enrich = create_enrich(folders, options, api.url)
+    table = tables_of_type(enrich, 'node')[0]
+    rng = random.Random(options.seed)
+    rows = dict((osm_id, None) for osm_id in rng.sample(range(1, 10000000), options.rows))
+    database = FakeDatabase({table: rows})
+    enrich.connection_pool = FakeConnectionPool(database)
+
+    start = monotonic()
+    enrich.process_empty_changeset_from_table(
+        table, enrich.mapping_database_schema[table]['osm_id_columnn'], 'node')
+    wall = monotonic() - start
+    api.stop()
+    return {
+        'wall_seconds': wall,
+        'elements': options.rows,
+        'db_round_trips': database.round_trips,
+        'updated_rows': database.updated_rows,
+        'api_calls': api.requests
+    }
+
+
+def benchmark_import_diff(folders, options):
+    """Importer._import_diff on the synthetic diffs of import_queue.
+
+    imposm is replaced by a stand-in which decompresses the diffs, so the
+    benchmark measures the queue, the batches and the manifest.
+    """
+    write_diffs(folders['import_queue'], options)
+    os.environ.update({
+        'SETTINGS': folders['settings'],
+        'CACHE': folders['cache'],
+        'IMPORT_QUEUE': folders['import_queue'],
+        'IMPORT_DONE': folders['import_done'],
+        'DIFF_BATCH_COUNT': str(options.diff_batch_count),
+        'VACUUM_AFTER_DIFFS': 'no',
+        'METRICS_PORT': '0'
+    })
+    sys.path.insert(0, join(ROOT, 'docker-imposm'))
+    import importer as importer_module
+
+    calls = []
+
+    def imposm(command):
+        for diff in command[command.index('-connection') + 2:]:
+            with gzip.open(diff, 'rb') as f:
+                while f.read(1048576):
+                    pass
+        calls.append(command)
+        return 0
+
+    def wait_for_diff():
+        raise QueueDrained()
+
+    importer_module.call = imposm
+    importer = importer_module.Importer()
+    importer.overwrite_environment()
+    importer.mapping_file = join(folders['settings'], 'mapping.yml')
+    importer.postgis_uri = 'postgis://benchmark'
+    importer.start_metrics()
+    importer._wait_for_diff = wait_for_diff
+
+    start = monotonic()
+    try:
+        importer._import_diff([])
+    except QueueDrained:
+        pass
+    wall = monotonic() - start
+    return {
+        'wall_seconds': wall,
+        'elements': options.diffs * options.elements,
+        'db_round_trips': 0,
+        'imposm_calls': len(calls)
+    }
+
+
+def run_benchmark(name, options):
+    """Run one benchmark in this process and return its measures."""
+    root, folders = create_folders()
+    try:
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            result = globals()['benchmark_%s' % name](folders, options)
+    finally:
+        rmtree(root)
+    result['elements_per_second'] = result['elements'] / max(result['wall_seconds'], 0.000001)
+    result['peak_rss_kb'] = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return result
+
+
+def compare(baseline, results, tolerance):
+    """Return the regressions of the results against the baseline."""
+    regressions = []
+    for name, result in results.items():
+        previous = baseline['benchmarks'].get(name)
+        if not previous:
+            continue
+        if result['elements_per_second'] < previous['elements_per_second'] * (1 - tolerance):
+            regressions.append('%s: %.0f elements/s, %.0f in the baseline' % (
+                name, result['elements_per_second'], previous['elements_per_second']))
+        if result['db_round_trips'] > previous['db_round_trips']:
+            regressions.append('%s: %s round-trips, %s in the baseline' % (
+                name, result['db_round_trips'], previous['db_round_trips']))
+        if result['peak_rss_kb'] > previous['peak_rss_kb'] * (1 + tolerance):
+            regressions.append('%s: %s KB peak RSS, %s KB in the baseline' % (
+                name, result['peak_rss_kb'], previous['peak_rss_kb']))
+    return regressions
+
+
+if __name__ == '__main__':
+    arguments = ArgumentParser(description='Benchmark the diff import and enrich hot paths.')
+    arguments.add_argument('--only', choices=BENCHMARKS, action='append',
+                           help='Run only this benchmark, can be repeated')
+    arguments.add_argument('--seed', type=int, default=0)
+    arguments.add_argument('--diffs', type=int, default=4, help='Number of synthetic diffs')
+    arguments.add_argument('--elements', type=int, default=20000, help='Number of elements of each diff')
+    arguments.add_argument('--hit-ratio', type=float, default=0.3,
+                           help='Share of the modified elements which are in the database')
+    arguments.add_argument('--rows', type=int, default=5000, help='Number of rows without changeset')
+    arguments.add_argument('--api-latency', type=float, default=0.01, help='Latency of the stub OSM API')
+    arguments.add_argument('--api-workers', type=int, default=4)
+    arguments.add_argument('--diff-workers', type=int, default=1)
+    arguments.add_argument('--diff-batch-count', type=int, default=1)
+    arguments.add_argument('--output', help='Write the results in this JSON file')
+    arguments.add_argument('--compare', help='Fail if the results regress from this JSON baseline')
+    arguments.add_argument('--tolerance', type=float, default=0.25,
+                           help='Accepted slowdown or memory growth against the baseline')
+    arguments.add_argument('--child', choices=BENCHMARKS, help=SUPPRESS)
+    options = arguments.parse_args()
+
+    if options.child:
+        print(json.dumps(run_benchmark(options.child, options)))
+        sys.exit()
+
+    # Every benchmark runs in its own process, so its peak RSS is its own.
+    results = {}
+    for name in options.only or BENCHMARKS:
+        process = run([sys.executable, abspath(__file__), '--child', name] + sys.argv[1:],
+                      stdout=PIPE, check=True)
+        results[name] = json.loads(process.stdout.decode('utf-8').strip().splitlines()[-1])
+        print('%s: %.2f s, %.0f elements/s, %s round-trips, %s KB peak RSS' % (
+            name, results[name]['wall_seconds'], results[name]['elements_per_second'],
+            results[name]['db_round_trips'], results[name]['peak_rss_kb']))
+
+    report = {
+        'created_at': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'python': platform.python_version(),
+        'parameters': dict(
+            (key, value) for key, value in vars(options).items()
+            if key not in ('only', 'output', 'compare', 'tolerance', 'child')),
+        'benchmarks': results
+    }
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+    if options.compare:
+        with open(options.compare) as baseline:
+            regressions = compare(json.load(baseline), results, options.tolerance)
+        for regression in regressions:
+            print('Regression %s' % regression)
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+/***************************************************************************
+                              Docker-OSM Benchmarks
+                    Stub of the OSM API answering the batched requests.
+ ***************************************************************************/
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Thread
+from time import sleep
+from urllib.parse import urlsplit, parse_qs
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubOsmApi(object):
+    """Answer /api/0.6/nodes?nodes=1,2 (and ways, relations) with a version of every id.
+
+    The latency in seconds is added to every response, to stand for the
+    distance to the real API.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.requests = 0
+        api = self
+
+        class StubHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                osm_types = url.path.rstrip('/').split('/')[-1]
+                osm_type = osm_types[:-1]
+                osm_ids = parse_qs(url.query).get(osm_types, [''])[0].split(',')
+                api.requests += 1
+                if api.latency:
+                    sleep(api.latency)
+                body = ['<?xml version="1.0" encoding="UTF-8"?>', '<osm version="0.6">']
+                for osm_id in osm_ids:
+                    body.append(
+                        '<%s id="%s" version="2" changeset="%s" timestamp="2021-01-01T00:00:00Z" '
+                        'user="benchmark" uid="1"/>' % (osm_type, osm_id, osm_id))
+                body.append('</osm>')
+                body = '\n'.join(body).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/xml')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingServer(('127.0.0.1', 0), StubHandler)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s/api/0.6/' % self.server.server_address[1]
+
+    def start(self):
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
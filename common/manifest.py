@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+/***************************************************************************
+                              Docker-OSM
+                    Manifest of the diffs shared by the services.
+                        -------------------
+        begin                : 2015-07-15
+        email                : etienne at kartoza dot com
+        contributor          : Etienne Trimaille
+ ***************************************************************************/
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+# Manifest of the diffs, shared by the downloader, the importer and enrich.
+MANIFEST_SCHEMA = """
+CREATE TABLE IF NOT EXISTS diffs (
+    sequence INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL UNIQUE,
+    from_timestamp TEXT NOT NULL,
+    to_timestamp TEXT NOT NULL,
+    size INTEGER,
+    checksum TEXT,
+    downloaded_at TEXT,
+    imported_at TEXT,
+    enriched_at TEXT
+);
+CREATE INDEX IF NOT EXISTS diffs_not_imported ON diffs (sequence) WHERE imported_at IS NULL;
+CREATE INDEX IF NOT EXISTS diffs_not_enriched ON diffs (sequence) WHERE enriched_at IS NULL;
+CREATE TABLE IF NOT EXISTS manifest_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
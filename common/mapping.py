@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+/***************************************************************************
+                              Docker-OSM
+                    Mapping of imposm in the settings folder.
+                        -------------------
+        begin                : 2015-07-15
+        email                : etienne at kartoza dot com
+        contributor          : Etienne Trimaille
+ ***************************************************************************/
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+
+from os import listdir
+from os.path import join
+
+# YAML files of the settings folder which are not the imposm mapping.
+NOT_MAPPING = ('scale_bands.yml',)
+
+
+def find_mapping_file(settings_folder, extensions=('.yml', '.json')):
+    """Return the path of the imposm mapping in the settings folder, or None.
+
+    The first extension wins, YML is the new format of the mapping.
+    """
+    files = sorted(listdir(settings_folder))
+    for extension in extensions:
+        for f in files:
+            if f.endswith(extension) and f not in NOT_MAPPING:
+                return join(settings_folder, f)
+    return None
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+/***************************************************************************
+                              Docker-OSM
+                    Metrics shared by the services.
+                        -------------------
+        begin                : 2015-07-15
+        email                : etienne at kartoza dot com
+        contributor          : Etienne Trimaille
+ ***************************************************************************/
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import json
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from os import listdir, replace
+from os.path import join, getmtime
+from threading import Lock, Thread
+from time import monotonic
+
+
+class Metrics(object):
+    """Timing and throughput metrics of a service of the pipeline.
+
+    The metrics are served in the Prometheus text format on METRICS_PORT and
+    written in a JSON status file in the settings folder. The queue depth, the
+    age of the oldest queued diff and the replication lag are read when the
+    metrics are collected.
+    """
+
+    def __init__(self, service, metrics, settings_folder, import_queue=None):
+        self.service = service
+        self.metrics = dict(metrics)
+        self.metrics.update({
+            'docker_osm_replication_lag_seconds': ('gauge', 'Now minus the timestamp of the database.'),
+            'docker_osm_queue_depth': ('gauge', 'Number of diffs waiting to be imported.'),
+            'docker_osm_queue_oldest_age_seconds': ('gauge', 'Age of the oldest diff waiting to be imported.')
+        })
+        self.status_file = join(settings_folder, 'status_%s.json' % service)
+        self.timestamp_file = join(settings_folder, 'timestamp.txt')
+        self.import_queue = import_queue
+        self.values = {}
+        self.lock = Lock()
+        self.status_time = 0
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + value
+        self.write_status()
+
+    def set(self, name, value):
+        with self.lock:
+            self.values[name] = value
+        self.write_status()
+
+    def observe(self, name, value):
+        with self.lock:
+            total, count = self.values.get(name, (0, 0))
+            self.values[name] = (total + value, count + 1)
+        self.write_status()
+
+    def collect(self):
+        """Copy of the values with the state of the pipeline."""
+        with self.lock:
+            values = dict(self.values)
+
+        now = datetime.now(timezone.utc)
+        try:
+            with open(self.timestamp_file) as timestamp_file:
+                timestamp = datetime.strptime(
+                    timestamp_file.read().strip(), '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc)
+            values['docker_osm_replication_lag_seconds'] = (now - timestamp).total_seconds()
+        except (IOError, ValueError):
+            pass
+
+        if self.import_queue:
+            queued = []
+            for diff in listdir(self.import_queue):
+                if not diff.startswith('.'):
+                    try:
+                        queued.append(getmtime(join(self.import_queue, diff)))
+                    except OSError:
+                        pass
+            values['docker_osm_queue_depth'] = len(queued)
+            values['docker_osm_queue_oldest_age_seconds'] = now.timestamp() - min(queued) if queued else 0
+        return values
+
+    def render(self):
+        """Metrics in the Prometheus text format."""
+        values = self.collect()
+        lines = []
+        for name in sorted(values):
+            metric_type, help_text = self.metrics[name]
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            if metric_type == 'summary':
+                lines.append('%s_sum{service="%s"} %s' % (name, self.service, values[name][0]))
+                lines.append('%s_count{service="%s"} %s' % (name, self.service, values[name][1]))
+            else:
+                lines.append('%s{service="%s"} %s' % (name, self.service, values[name]))
+        return '\n'.join(lines) + '\n'
+
+    def status(self):
+        values = self.collect()
+        for name, value in values.items():
+            if self.metrics[name][0] == 'summary':
+                values[name] = {'sum': value[0], 'count': value[1]}
+        return {
+            'service': self.service,
+            'updated_at': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'metrics': values
+        }
+
+    def write_status(self, force=False):
+        """Write the JSON status file, at most every 5 seconds unless forced."""
+        if not force and monotonic() - self.status_time < 5:
+            return
+        self.status_time = monotonic()
+        try:
+            with open(self.status_file + '.tmp', 'w') as status_file:
+                json.dump(self.status(), status_file, indent=2)
+            replace(self.status_file + '.tmp', self.status_file)
+        except (IOError, OSError):
+            pass
+
+    def start(self, port):
+        """Serve /metrics, and the JSON status on /status, in a background thread."""
+        self.write_status(force=True)
+        if int(port) <= 0:
+            return
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body = metrics.render().encode('utf-8')
+                    content_type = 'text/plain; version=0.0.4'
+                elif self.path == '/status':
+                    body = json.dumps(metrics.status()).encode('utf-8')
+                    content_type = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('', int(port)), MetricsHandler)
+        Thread(target=server.serve_forever, daemon=True).start()
@@ -0,0 +1,21 @@
+from os.path import join
+
+from mapping import find_mapping_file
+
+
+def test_find_mapping_file_skips_scale_bands(tmpdir):
+    tmpdir.join('scale_bands.yml').write('layers: {}')
+    tmpdir.join('mapping.yml').write('tables: {}')
+    assert find_mapping_file(str(tmpdir)) == join(str(tmpdir), 'mapping.yml')
+
+
+def test_find_mapping_file_prefers_yml(tmpdir):
+    tmpdir.join('mapping.json').write('{}')
+    tmpdir.join('mapping.yml').write('tables: {}')
+    assert find_mapping_file(str(tmpdir)) == join(str(tmpdir), 'mapping.yml')
+    assert find_mapping_file(str(tmpdir), ('.json',)) == join(str(tmpdir), 'mapping.json')
+
+
+def test_find_mapping_file_missing(tmpdir):
+    tmpdir.join('scale_bands.yml').write('layers: {}')
+    assert find_mapping_file(str(tmpdir)) is None
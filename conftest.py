@@ -0,0 +1,5 @@
+# The modules of common/ are copied next to the script of each service in the images.
+import sys
+from os.path import abspath, dirname, join
+
+sys.path.insert(0, join(dirname(abspath(__file__)), 'common'))
@@ -18,15 +18,177 @@
  *                                                                         *
  ***************************************************************************/
 """
+import json
+import re
+import sqlite3
 import sys
-from os import environ, listdir
-from os.path import join, exists, abspath, isabs
-from shutil import move
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from hashlib import sha256
+from io import StringIO
+from os import environ, listdir, makedirs
+from os.path import join, exists, abspath, isabs, getsize
+from queue import Queue
+from shutil import move, rmtree
 from subprocess import call
 from sys import exit, stderr
-from time import sleep
+from threading import Lock, Thread, local as threading_local
+from time import sleep, monotonic
 
-from psycopg2 import connect, OperationalError
+from psycopg2 import connect, Error, InterfaceError, OperationalError
+from psycopg2.extras import execute_values
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+from manifest import MANIFEST_SCHEMA
+from mapping import find_mapping_file
+from metrics import Metrics
+
+# Metrics of the importer.
+METRICS = {
+    'docker_osm_imposm_diff_seconds': ('summary', 'Wall time of imposm for each imported diff.'),
+    'docker_osm_imposm_diff_batch_seconds': ('summary', 'Wall time of each imposm diff call.'),
+    'docker_osm_diffs_imported_total': ('counter', 'Number of imported diffs.'),
+    'docker_osm_diff_import_bytes_total': ('counter', 'Size of the imported diffs.'),
+    'docker_osm_clip_seconds': ('summary', 'Wall time of the clip of the rows of each diff batch.'),
+    'docker_osm_clip_removed_rows_total': ('counter', 'Number of rows outside the clip removed after the diffs.'),
+    'docker_osm_sql_statement_seconds': ('summary', 'Wall time of each statement of the SQL files.'),
+    'docker_osm_vacuum_seconds': ('summary', 'Wall time of each VACUUM (ANALYZE) after the diffs.'),
+    'docker_osm_vacuums_total': ('counter', 'Number of tables vacuumed after the diffs.')
+}
+
+# Log of the statements of the SQL files run by the importer, and hash of the SQL files applied.
+DOCKER_OSM_SCHEMA = """
+CREATE SCHEMA IF NOT EXISTS docker_osm;
+CREATE TABLE IF NOT EXISTS docker_osm.artifacts (
+    name text PRIMARY KEY,
+    sha256 text NOT NULL,
+    applied_at timestamp with time zone NOT NULL DEFAULT now()
+);
+CREATE TABLE IF NOT EXISTS docker_osm.sql_log (
+    id serial PRIMARY KEY,
+    script text NOT NULL,
+    position integer NOT NULL,
+    parallel boolean NOT NULL,
+    statement text NOT NULL,
+    seconds double precision NOT NULL,
+    error text,
+    run_at timestamp with time zone NOT NULL DEFAULT now()
+);
+"""
+
+DOLLAR_QUOTE = re.compile(r'\$[A-Za-z_]*\$')
+COPY_FROM_STDIN = re.compile(r'(COPY\s[^;]*\sFROM\s+stdin[^;]*);\n', re.IGNORECASE)
+COPY_TABLE = re.compile(r'COPY\s+(\S+)\s*\(([^)]*)\)', re.IGNORECASE)
+SESSION_SETTING = re.compile(r'^(SET\s|SELECT\s+pg_catalog\.set_config\()', re.IGNORECASE)
+# Header of materialized_views.sql, written by settings/materialized_views.py.
+# Natural keys of the tables upserted from the dumps, the serial ids of their rows differ between databases.
+UPSERT_KEYS = {
+    'public.layer_styles': ('f_table_schema', 'f_table_name', 'f_geometry_column', 'stylename')
+}
+SHARD_INDEX_TABLE = re.compile(r' ON (ONLY )?\S+ USING ')
+GENERATED_SETTING = re.compile(r'^-- (Schema|Owner): (\S+)$')
+
+
+def file_digest(file_path):
+    """SHA-256 of the content of a file."""
+    digest = sha256()
+    with open(file_path, 'rb') as artifact:
+        for block in iter(lambda: artifact.read(1048576), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def split_sql(script):
+    """Split an SQL script in sections of statements.
+
+    The statements between a `-- @parallel` line and a `-- @end parallel`
+    line are independent of each other, like the index builds of several
+    tables, and can run concurrently. A COPY FROM stdin statement is kept
+    with its data, up to the `\\.` line, as in the dumps of pg_dump.
+
+    :return: List of parallel flag and statements of each section
+    :rtype: list
+    """
+    sections = [(False, [])]
+    statement = []
+    index = 0
+    length = len(script)
+    while index < length:
+        char = script[index]
+        if char == '-' and script.startswith('--', index):
+            end = script.find('\n', index)
+            end = length if end == -1 else end
+            marker = script[index + 2:end].strip().lower()
+            if marker in ('@parallel', '@end parallel') and not ''.join(statement).strip():
+                sections.append((marker == '@parallel', []))
+            index = end
+            continue
+        if char == '/' and script.startswith('/*', index):
+            end = script.find('*/', index + 2)
+            index = length if end == -1 else end + 2
+            continue
+        if char == '\\' and not ''.join(statement).strip():
+            # psql meta-commands are not SQL.
+            end = script.find('\n', index)
+            index = length if end == -1 else end
+            continue
+        if char in ('\'', '"'):
+            escaped = char == '\'' and index > 0 and script[index - 1] in 'Ee' and (
+                index == 1 or not (script[index - 2].isalnum() or script[index - 2] == '_'))
+            end = index + 1
+            while end < length:
+                if escaped and script[end] == '\\':
+                    end += 2
+                    continue
+                if script[end] == char:
+                    if script.startswith(char * 2, end):
+                        end += 2
+                        continue
+                    break
+                end += 1
+            statement.append(script[index:end + 1])
+            index = end + 1
+            continue
+        if char == '$':
+            tag = DOLLAR_QUOTE.match(script, index)
+            if tag and not (index > 0 and (script[index - 1].isalnum() or script[index - 1] == '_')):
+                end = script.find(tag.group(0), tag.end())
+                end = length if end == -1 else end + len(tag.group(0))
+                statement.append(script[index:end])
+                index = end
+                continue
+        if char == ';':
+            text = ''.join(statement).strip()
+            index += 1
+            copy = COPY_FROM_STDIN.match(text + ';\n')
+            if copy and copy.end() == len(text) + 2:
+                data_start = script.find('\n', index)
+                data_start = length if data_start == -1 else data_start + 1
+                index = data_start
+                while index < length and not script.startswith('\\.', index):
+                    end = script.find('\n', index)
+                    index = length if end == -1 else end + 1
+                text += ';\n' + script[data_start:index]
+                end = script.find('\n', index)
+                index = length if end == -1 else end
+            if text:
+                sections[-1][1].append(text)
+            statement = []
+            continue
+        statement.append(char)
+        index += 1
+    text = ''.join(statement).strip()
+    if text:
+        sections[-1][1].append(text)
+    return [section for section in sections if section[1]]
+
+
+def diff_time():
+    return datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
 
 
 class Importer(object):
@@ -46,11 +208,25 @@ class Importer(object):
             'IMPORT_QUEUE': 'import_queue',
             'SRID': '4326',
             'OPTIMIZE': 'false',
+            'BULK_LOAD': 'no',
+            'BULK_LOAD_MAINTENANCE_WORK_MEM': '1GB',
             'DBSCHEMA_PRODUCTION': 'public',
             'DBSCHEMA_IMPORT': 'import',
             'DBSCHEMA_BACKUP': 'backup',
             'CLIP': 'no',
+            'CLIP_WORKERS': '4',
+            'SQL_WORKERS': '4',
             'QGIS_STYLE': 'yes',
+            'MATERIALIZED_VIEWS': 'no',
+            'DIFF_BATCH_COUNT': '1',
+            'DIFF_BATCH_BYTES': '500000000',
+            'VACUUM_AFTER_DIFFS': 'yes',
+            'VACUUM_CHURN_ROWS': '10000',
+            'VACUUM_CHURN_RATIO': '0.05',
+            'IMPORT_SHARDS': '1',
+            'IMPORT_SHARD_WORKERS': '4',
+            'IMPORT_SHARD_BBOX': '-180,-90,180,90',
+            'METRICS_PORT': '9898',
             'SSL_MODE': 'disable',
             'SSL_CERT': None,
             'SSL_ROOT_CERT': None,
@@ -61,8 +237,19 @@ class Importer(object):
         self.post_import_file = None
         self.clip_json_file = None
         self.qgis_style = None
+        self.materialized_views_file = None
+        # OSM tables without id or geometry column, logged once.
+        self.unclipped_tables = set()
         self.cursor = None
         self.postgis_uri = None
+        self.conn_parameters = None
+        self.queue_watcher = None
+        self.manifest = None
+        self.metrics = None
+        self.churn_baseline = {}
+        self.vacuum_queue = None
+        self.vacuum_pending = set()
+        self.vacuum_lock = Lock()
 
     @staticmethod
     def info(message):
@@ -103,6 +290,46 @@ class Importer(object):
             self.error(msg)
         else:
             self.info('QGIS style: ' + self.default['QGIS_STYLE'])
+        # Check valid MATERIALIZED_VIEWS.
+        if self.default['MATERIALIZED_VIEWS'] not in ['yes', 'no']:
+            msg = 'MATERIALIZED_VIEWS not supported : %s' % self.default['MATERIALIZED_VIEWS']
+            self.error(msg)
+        else:
+            self.info('Materialized views: ' + self.default['MATERIALIZED_VIEWS'])
+
+        # Check valid OPTIMIZE.
+        if self.default['OPTIMIZE'] not in ['true', 'false']:
+            msg = 'OPTIMIZE not supported : %s' % self.default['OPTIMIZE']
+            self.error(msg)
+        else:
+            self.info('Optimize: ' + self.default['OPTIMIZE'])
+        # Check valid BULK_LOAD.
+        if self.default['BULK_LOAD'] not in ['yes', 'no']:
+            msg = 'BULK_LOAD not supported : %s' % self.default['BULK_LOAD']
+            self.error(msg)
+        else:
+            self.info('Bulk load: ' + self.default['BULK_LOAD'])
+
+        # Check valid VACUUM_AFTER_DIFFS.
+        if self.default['VACUUM_AFTER_DIFFS'] not in ['yes', 'no']:
+            msg = 'VACUUM_AFTER_DIFFS not supported : %s' % self.default['VACUUM_AFTER_DIFFS']
+            self.error(msg)
+        else:
+            self.info('Vacuum after diffs: ' + self.default['VACUUM_AFTER_DIFFS'])
+
+        # Check valid IMPORT_SHARD_BBOX.
+        try:
+            min_lon, min_lat, max_lon, max_lat = [
+                float(value) for value in self.default['IMPORT_SHARD_BBOX'].split(',')]
+        except ValueError:
+            msg = 'IMPORT_SHARD_BBOX not supported : %s' % self.default['IMPORT_SHARD_BBOX']
+            self.error(msg)
+        else:
+            if min_lon >= max_lon or min_lat >= max_lat:
+                msg = 'IMPORT_SHARD_BBOX is empty : %s' % self.default['IMPORT_SHARD_BBOX']
+                self.error(msg)
+        if int(self.default['IMPORT_SHARDS']) > 1:
+            self.info('Sharded initial import: %s shards' % self.default['IMPORT_SHARDS'])
 
         # Check folders.
         folders = ['IMPORT_QUEUE', 'IMPORT_DONE', 'SETTINGS', 'CACHE']
@@ -117,18 +344,12 @@ class Importer(object):
                 self.error(msg)
 
         # Test files
+        self.mapping_file = find_mapping_file(self.default['SETTINGS'])
         for f in listdir(self.default['SETTINGS']):
 
             if f.endswith('.pbf'):
                 self.osm_file = join(self.default['SETTINGS'], f)
 
-            # JSON first then YML (YML is the new format)
-            if f.endswith('.json'):
-                self.mapping_file = join(self.default['SETTINGS'], f)
-
-            if f.endswith('.yml'):
-                self.mapping_file = join(self.default['SETTINGS'], f)
-
             if f == 'post-pbf-import.sql':
                 self.post_import_file = join(self.default['SETTINGS'], f)
 
@@ -138,6 +359,9 @@ class Importer(object):
             if f == 'qgis_style.sql':
                 self.qgis_style = join(self.default['SETTINGS'], f)
 
+            if f == 'materialized_views.sql':
+                self.materialized_views_file = join(self.default['SETTINGS'], f)
+
         if not self.osm_file:
             msg = 'OSM file *.pbf is missing in %s' % self.default['SETTINGS']
             self.error(msg)
@@ -167,6 +391,12 @@ class Importer(object):
         else:
             self.info('Not using QGIS default styles.')
 
+        if not self.materialized_views_file and self.default['MATERIALIZED_VIEWS'] == 'yes':
+            msg = 'materialized_views.sql is missing in %s and MATERIALIZED_VIEWS = yes.' % self.default['SETTINGS']
+            self.error(msg)
+        elif self.default['MATERIALIZED_VIEWS'] == 'yes':
+            self.check_materialized_views_file()
+
         if not self.clip_json_file and self.default['CLIP'] == 'yes':
             msg = 'clip.geojson is missing and CLIP = yes.'
             self.error(msg)
@@ -178,6 +408,11 @@ class Importer(object):
         # In docker-compose, we should wait for the DB is ready.
         self.info('The checkup is OK.')
 
+    def start_metrics(self):
+        """Serve the metrics of the importer."""
+        self.metrics = Metrics('imposm', METRICS, self.default['SETTINGS'], self.default['IMPORT_QUEUE'])
+        self.metrics.start(self.default['METRICS_PORT'])
+
     def create_timestamp(self):
         """Create the timestamp with the undefined value until the real one."""
         file_path = join(self.default['SETTINGS'], 'timestamp.txt')
@@ -192,6 +427,50 @@ class Importer(object):
         timestamp_file.write('%s\n' % database_timestamp)
         timestamp_file.close()
 
+    def open_manifest(self):
+        """Open the manifest of the diffs shared with the downloader and enrich."""
+        if self.manifest is None:
+            self.manifest = sqlite3.connect(
+                join(self.default['SETTINGS'], 'manifest.sqlite'), timeout=60)
+            self.manifest.executescript(MANIFEST_SCHEMA)
+        return self.manifest
+
+    def backfill_manifest(self):
+        """Add the diffs downloaded before the manifest existed, only once."""
+        manifest = self.open_manifest()
+        if manifest.execute(
+                "SELECT value FROM manifest_meta WHERE key = 'backfilled'").fetchone():
+            return
+        self.info('Adding the existing diffs in the manifest.')
+        diffs = [(diff, 'IMPORT_DONE') for diff in listdir(self.default['IMPORT_DONE'])]
+        diffs += [(diff, 'IMPORT_QUEUE') for diff in self._list_import_queue()]
+        with manifest:
+            for diff, folder in sorted(diffs):
+                from_timestamp, to_timestamp = diff.split('.')[0].split('->-')
+                manifest.execute(
+                    'INSERT OR IGNORE INTO diffs (name, from_timestamp, to_timestamp, size, imported_at) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (diff, from_timestamp, to_timestamp,
+                     getsize(join(self.default[folder], diff)),
+                     diff_time() if folder == 'IMPORT_DONE' else None))
+            manifest.execute(
+                "INSERT INTO manifest_meta (key, value) VALUES ('backfilled', ?)", (diff_time(),))
+
+    def update_manifest(self, diffs):
+        """Mark the diffs as imported in the manifest."""
+        manifest = self.open_manifest()
+        with manifest:
+            for diff in diffs:
+                from_timestamp, to_timestamp = diff.split('.')[0].split('->-')
+                # The diff may not come from the downloader.
+                manifest.execute(
+                    'INSERT OR IGNORE INTO diffs (name, from_timestamp, to_timestamp, size) '
+                    'VALUES (?, ?, ?, ?)',
+                    (diff, from_timestamp, to_timestamp,
+                     getsize(join(self.default['IMPORT_DONE'], diff))))
+                manifest.execute(
+                    'UPDATE diffs SET imported_at = ? WHERE name = ?', (diff_time(), diff))
+
     def check_postgis(self):
         """Test connection to PostGIS and create the URI."""
         if self.default['SSL_MODE'] == 'verify-ca' or self.default['SSL_MODE'] == 'verify-full':
@@ -223,6 +502,7 @@ class Importer(object):
         try:
             connection = connect(conn_parameters)
             self.cursor = connection.cursor()
+            self.conn_parameters = conn_parameters
         except OperationalError as e:
             self.error(e)
 
@@ -259,27 +539,245 @@ class Importer(object):
                 self.default['POSTGRES_PORT'],
                 self.default['POSTGRES_DBNAME'])
 
+    @staticmethod
+    def _copy_upsert(cursor, copy, data):
+        """Upsert the rows of a COPY statement in its table.
+
+        The rows are matched on the natural key of the table in UPSERT_KEYS, the
+        primary key is left to the sequence of the table so the rows added in the
+        database keep their ids. Without natural key, the rows are matched on the
+        primary key.
+        """
+        table, columns = COPY_TABLE.match(copy).groups()
+        columns = [column.strip() for column in columns.split(',')]
+        cursor.execute(
+            'SELECT attribute.attname FROM pg_catalog.pg_index AS index '
+            'JOIN pg_catalog.pg_attribute AS attribute '
+            'ON attribute.attrelid = index.indrelid AND attribute.attnum = ANY(index.indkey) '
+            'WHERE index.indrelid = %s::pg_catalog.regclass AND index.indisprimary', (table,))
+        primary_keys = [key for key, in cursor.fetchall()]
+        keys = UPSERT_KEYS.get(table)
+        try:
+            cursor.execute('CREATE TEMPORARY TABLE upsert_staging (LIKE %s)' % table)
+            cursor.copy_expert(
+                'COPY pg_temp.upsert_staging (%s) FROM stdin' % ', '.join(columns), StringIO(data))
+            if not keys:
+                cursor.execute(
+                    'INSERT INTO %s (%s) SELECT %s FROM pg_temp.upsert_staging ON CONFLICT (%s) DO UPDATE SET %s' % (
+                        table, ', '.join(columns), ', '.join(columns), ', '.join(primary_keys),
+                        ', '.join('%s = EXCLUDED.%s' % (column, column)
+                                  for column in columns if column not in primary_keys)))
+                return
+
+            # The ids of the dump are not used, the new rows take theirs from the sequence,
+            # moved ahead of every id of the table.
+            for key in primary_keys:
+                cursor.execute('SELECT pg_catalog.pg_get_serial_sequence(%s, %s)', (table, key))
+                sequence, = cursor.fetchone()
+                if sequence:
+                    cursor.execute(
+                        'SELECT pg_catalog.setval(%%s, GREATEST((SELECT last_value FROM %s), '
+                        '(SELECT coalesce(max(%s), 0) FROM %s), 1))' % (sequence, key, table), (sequence,))
+            values = [column for column in columns if column not in primary_keys]
+            match = ' AND '.join(
+                'target.%s IS NOT DISTINCT FROM staging.%s' % (key, key) for key in keys)
+            cursor.execute(
+                'UPDATE %s AS target SET %s FROM pg_temp.upsert_staging AS staging WHERE %s' % (
+                    table, ', '.join('%s = staging.%s' % (column, column) for column in values if column not in keys),
+                    match))
+            cursor.execute(
+                'INSERT INTO %s (%s) SELECT %s FROM pg_temp.upsert_staging AS staging '
+                'WHERE NOT EXISTS (SELECT 1 FROM %s AS target WHERE %s)' % (
+                    table, ', '.join(values), ', '.join('staging.%s' % column for column in values), table, match))
+        finally:
+            cursor.execute('DROP TABLE IF EXISTS pg_temp.upsert_staging')
+
+    def _execute_statement(self, cursor, statement, upsert=False):
+        """Execute a statement, autocommitted.
+
+        :return: Time spent in seconds and the error if any
+        :rtype: (float, str)
+        """
+        start = monotonic()
+        try:
+            copy = COPY_FROM_STDIN.match(statement)
+            if copy and upsert:
+                self._copy_upsert(cursor, copy.group(1), statement[copy.end():])
+            elif copy:
+                cursor.copy_expert(copy.group(1), StringIO(statement[copy.end():]))
+            else:
+                cursor.execute(statement)
+            error = None
+        except Error as e:
+            error = str(e).strip()
+        elapsed = monotonic() - start
+        self.metrics.observe('docker_osm_sql_statement_seconds', elapsed)
+        return elapsed, error
+
+    def _execute_parallel(self, statements, session_settings):
+        """Execute independent statements over SQL_WORKERS connections.
+
+        Each connection replays the session settings of the script first.
+        """
+        connections = []
+        connections_lock = Lock()
+        local = threading_local()
+
+        def execute(statement):
+            if not hasattr(local, 'cursor'):
+                connection = connect(self.conn_parameters)
+                connection.autocommit = True
+                with connections_lock:
+                    connections.append(connection)
+                local.cursor = connection.cursor()
+                for setting in session_settings:
+                    local.cursor.execute(setting)
+            return self._execute_statement(local.cursor, statement)
+
+        try:
+            with ThreadPoolExecutor(max_workers=int(self.default['SQL_WORKERS'])) as executor:
+                return list(executor.map(execute, statements))
+        finally:
+            for connection in connections:
+                connection.close()
+
+    def run_sql_file(self, file_path, stop_on_error=False, upsert=False):
+        """Run an SQL file statement by statement in its own session, like psql -f.
+
+        The sections marked with -- @parallel run concurrently. The time of
+        every statement is logged in docker_osm.sql_log. With upsert, only the
+        settings and the COPY statements of a dump run, and the rows of the
+        COPY statements are upserted in the existing tables. The setval of the
+        dump would move the sequences back below the ids of the existing rows.
+
+        :return: Number of statements which failed
+        :rtype: int
+        """
+        with open(file_path, encoding='utf-8') as sql_file:
+            sections = split_sql(sql_file.read())
+        script = file_path.split('/')[-1]
+        if upsert:
+            sections = [
+                (parallel, [
+                    statement for statement in statements
+                    if COPY_FROM_STDIN.match(statement) or SESSION_SETTING.match(statement)])
+                for parallel, statements in sections]
+
+        connection = connect(self.conn_parameters)
+        connection.autocommit = True
+        cursor = connection.cursor()
+        session_settings = []
+        log = []
+        start = monotonic()
+        try:
+            for parallel, statements in sections:
+                if parallel:
+                    results = self._execute_parallel(statements, session_settings)
+                else:
+                    results = []
+                    for statement in statements:
+                        results.append(self._execute_statement(cursor, statement, upsert))
+                        if results[-1][1] is None and SESSION_SETTING.match(statement):
+                            session_settings.append(statement)
+                        if results[-1][1] and stop_on_error:
+                            break
+                for statement, (elapsed, error) in zip(statements, results):
+                    log.append((script, len(log) + 1, parallel, statement[:1000], elapsed, error))
+                    if error:
+                        self.info('Error in %s, statement %s : %s' % (script, len(log), error))
+                if stop_on_error and any(error for elapsed, error in results):
+                    break
+        finally:
+            connection.close()
+
+        self.cursor.execute(DOCKER_OSM_SCHEMA)
+        execute_values(
+            self.cursor,
+            'INSERT INTO docker_osm.sql_log (script, position, parallel, statement, seconds, error) VALUES %s',
+            log)
+        self.cursor.connection.commit()
+        errors = len([entry for entry in log if entry[5]])
+        self.info('%s : %s statements in %.1f seconds, %s errors' % (script, len(log), monotonic() - start, errors))
+        return errors
+
+    def applied_artifact(self, name):
+        """SHA-256 of the SQL file last applied under this name, None if never applied."""
+        self.cursor.execute(DOCKER_OSM_SCHEMA)
+        self.cursor.execute('SELECT sha256 FROM docker_osm.artifacts WHERE name = %s', (name,))
+        artifact = self.cursor.fetchone()
+        self.cursor.connection.commit()
+        return artifact[0] if artifact else None
+
+    def record_artifact(self, name, digest):
+        """Record the SHA-256 of an SQL file applied without error."""
+        self.cursor.execute(DOCKER_OSM_SCHEMA)
+        self.cursor.execute(
+            'INSERT INTO docker_osm.artifacts (name, sha256) VALUES (%s, %s) '
+            'ON CONFLICT (name) DO UPDATE SET sha256 = EXCLUDED.sha256, applied_at = now()', (name, digest))
+        self.cursor.connection.commit()
+
     def import_custom_sql(self):
-        """Import the custom SQL file into the database."""
+        """Import the custom SQL file into the database.
+
+        It runs on the tables of a new import, so it runs even when unchanged.
+        """
         self.info('Running the post import SQL file.')
-        command = ['psql']
-        command += ['-h', self.default['POSTGRES_HOST']]
-        command += ['-p', self.default['POSTGRES_PORT']]
-        command += ['-U', self.default['POSTGRES_USER']]
-        command += ['-d', self.default['POSTGRES_DBNAME']]
-        command += ['-f', self.post_import_file]
-        call(command)
+        digest = file_digest(self.post_import_file)
+        if not self.run_sql_file(self.post_import_file):
+            self.record_artifact('post-pbf-import.sql', digest)
 
     def import_qgis_styles(self):
-        """Import the QGIS styles into the database."""
-        self.info('Installing QGIS styles.')
-        command = ['psql']
-        command += ['-h', self.default['POSTGRES_HOST']]
-        command += ['-p', self.default['POSTGRES_PORT']]
-        command += ['-U', self.default['POSTGRES_USER']]
-        command += ['-d', self.default['POSTGRES_DBNAME']]
-        command += ['-f', self.qgis_style]
-        call(command)
+        """Import the QGIS styles into the database.
+
+        The styles are skipped when qgis_style.sql is unchanged since the last
+        install, and upserted in the existing layer_styles table otherwise.
+        """
+        digest = file_digest(self.qgis_style)
+        if self.locate_table("'layer_styles'", 'public') == 1:
+            if self.applied_artifact('qgis_style.sql') == digest:
+                self.info('The QGIS styles are up to date.')
+                return
+            self.info('Updating QGIS styles.')
+            errors = self.run_sql_file(self.qgis_style, upsert=True)
+        else:
+            self.info('Installing QGIS styles.')
+            errors = self.run_sql_file(self.qgis_style)
+        if not errors:
+            self.record_artifact('qgis_style.sql', digest)
+
+    def check_materialized_views_file(self):
+        """Check materialized_views.sql was generated for the schema and the user of the database."""
+        expected = {
+            'Schema': ('schema', 'DBSCHEMA_PRODUCTION'),
+            'Owner': ('owner', 'POSTGRES_USER')
+        }
+        with open(self.materialized_views_file) as sql_file:
+            for line in sql_file:
+                match = GENERATED_SETTING.match(line.rstrip('\n'))
+                if not match:
+                    if line.startswith('--'):
+                        continue
+                    break
+                key, setting = expected[match.group(1)]
+                if match.group(2) != self.default[setting]:
+                    msg = (
+                        'materialized_views.sql is generated for the %s %s but %s = %s. '
+                        'Set %s in scale_bands.yml and run make materialized_views.' % (
+                            key, match.group(2), setting, self.default[setting], key))
+                    self.error(msg)
+
+    def materialized_views_changed(self):
+        """Whether materialized_views.sql changed since the bands were created."""
+        return self.applied_artifact('materialized_views.sql') != file_digest(self.materialized_views_file)
+
+    def import_materialized_views(self):
+        """Create the scale bands of the layers, kept up to date by triggers on the diffs."""
+        self.info('Creating the materialized views.')
+        digest = file_digest(self.materialized_views_file)
+        if self.run_sql_file(self.materialized_views_file, stop_on_error=True):
+            msg = 'An error occured while creating the materialized views.'
+            self.error(msg)
+        self.record_artifact('materialized_views.sql', digest)
 
     def locate_table(self, name, schema):
         """Check for tables in the DB table exists in the DB"""
@@ -298,14 +796,25 @@ class Importer(object):
 
             # It means that the DB is empty. Let's import the PBF file.
 
+            if int(self.default['IMPORT_SHARDS']) > 1:
+                first_pbf_import = self._sharded_pbf_import
+            else:
+                first_pbf_import = self._first_pbf_import
+
             if self.clip_json_file:
-                self._first_pbf_import(['-limitto', self.clip_json_file])
+                first_pbf_import(['-limitto', self.clip_json_file])
             else:
-                self._first_pbf_import([])
+                first_pbf_import([])
         else:
             self.info(
                 'The database is not empty. Let\'s import only diff files.')
 
+        # The bands are created once, then the triggers apply every diff to them.
+        if self.default['MATERIALIZED_VIEWS'] == 'yes' and (
+                osm_tables != 1 or self.locate_table("'bands'", 'materialized_views') != 1
+                or self.materialized_views_changed()):
+            self.import_materialized_views()
+
         if self.default['TIME'] != '0':
             if self.clip_json_file:
                 self._import_diff(['-limitto', self.clip_json_file])
@@ -314,74 +823,576 @@ class Importer(object):
         else:
             self.info('No more update to the database. Leaving.')
 
+    def _optimize_args(self):
+        """imposm clusters the tables on their geometry index and analyzes them with -optimize."""
+        return ['-optimize'] if self.default['OPTIMIZE'] == 'true' else []
+
+    def _import_uri(self):
+        """URI of the imposm connections of the first import.
+
+        With BULK_LOAD, the sessions of imposm, and only them, commit without
+        waiting for the WAL flush and build the indexes with more memory: the
+        settings are run-time parameters of the connection.
+        """
+        if self.default['BULK_LOAD'] != 'yes':
+            return self.postgis_uri
+        return '%s%ssynchronous_commit=off&maintenance_work_mem=%s' % (
+            self.postgis_uri, '&' if '?' in self.postgis_uri else '?',
+            self.default['BULK_LOAD_MAINTENANCE_WORK_MEM'])
+
+    def _analyze_import_schema(self):
+        """Analyze the tables of the import schema before they are deployed."""
+        self.cursor.execute(
+            "SELECT table_name FROM information_schema.tables "
+            "WHERE table_schema = %s AND table_type = 'BASE TABLE'",
+            (self.default['DBSCHEMA_IMPORT'],))
+        for table_name, in self.cursor.fetchall():
+            self.cursor.execute('ANALYZE "%s"."%s"' % (self.default['DBSCHEMA_IMPORT'], table_name))
+        self.cursor.connection.commit()
+
     def _first_pbf_import(self, args):
-        """Run the first PBF import into the database."""
-        command = ['imposm', 'import', '-diff', '-deployproduction']
-        command += ['-overwritecache', '-cachedir', self.default['CACHE']]
-        command += ['-srid', self.default['SRID']]
-        command += ['-dbschema-production',
-                    self.default['DBSCHEMA_PRODUCTION']]
-        command += ['-dbschema-import', self.default['DBSCHEMA_IMPORT']]
-        command += ['-dbschema-backup', self.default['DBSCHEMA_BACKUP']]
-        command += ['-diffdir', self.default['SETTINGS']]
-        command += ['-mapping', self.mapping_file]
-        command += ['-read', self.osm_file]
-        command += ['-write', '-connection', self.postgis_uri]
+        """Run the first PBF import into the database.
+
+        With BULK_LOAD, the tables are written, analyzed and deployed in
+        separate steps, each of them timed.
+        """
+        bulk_load = self.default['BULK_LOAD'] == 'yes'
+        command = self._import_command(
+            self.osm_file, self.default['CACHE'], self.default['SETTINGS'], self.default['DBSCHEMA_IMPORT'])
+        if not bulk_load:
+            command += ['-deployproduction'] + self._optimize_args()
         self.info('The database is empty. Let\'s import the PBF : %s' % self.osm_file)
 
         command.extend(args)
         self.info(command)
+        start = monotonic()
         if not call(command) == 0:
             msg = 'An error occured in imposm with the original file.'
             self.error(msg)
-        else:
-            self.info('Import PBF successful : %s' % self.osm_file)
+        import_time = monotonic() - start
+
+        if bulk_load:
+            analyze_start = monotonic()
+            if not self._optimize_args():
+                self._analyze_import_schema()
+            analyze_time = monotonic() - analyze_start
+            deploy_start = monotonic()
+            self._deploy_production()
+            deploy_time = monotonic() - deploy_start
+            self.info('Bulk load : written in %.1f seconds, analyzed in %.1f seconds, deployed in %.1f seconds' % (
+                import_time, analyze_time, deploy_time))
+        self.info('Import PBF successful in %.1f seconds : %s' % (monotonic() - start, self.osm_file))
 
-        if self.post_import_file or self.qgis_style:
-            # Set the password for psql
-            environ['PGPASSWORD'] = self.default['POSTGRES_PASS']
+        self._post_pbf_import()
 
+    def _import_command(self, osm_file, cache_folder, diff_folder, import_schema):
+        """imposm command writing a PBF file in the import schema, in diff mode.
+
+        The first import and its shards use it, so their tables and indexes are
+        the ones the diffs expect.
+        """
+        command = ['imposm', 'import', '-diff']
+        command += ['-overwritecache', '-cachedir', cache_folder]
+        command += ['-srid', self.default['SRID']]
+        command += ['-dbschema-production',
+                    self.default['DBSCHEMA_PRODUCTION']]
+        command += ['-dbschema-import', import_schema]
+        command += ['-dbschema-backup', self.default['DBSCHEMA_BACKUP']]
+        command += ['-diffdir', diff_folder]
+        command += ['-mapping', self.mapping_file]
+        command += ['-read', osm_file]
+        command += ['-write', '-connection', self._import_uri()]
+        return command
+
+    def _post_pbf_import(self):
+        """Run the custom SQL and install the QGIS styles after the first PBF import."""
         if self.post_import_file:
             self.import_custom_sql()
 
         if self.qgis_style:
             self.import_qgis_styles()
 
+    def _shard_bboxes(self):
+        """Split the extent of the import in strips of longitude, one for each shard.
+
+        The extent is the bounding box of clip.geojson if any, IMPORT_SHARD_BBOX otherwise.
+        """
+        if self.clip_json_file:
+            with open(self.clip_json_file) as clip_file:
+                clip = json.load(clip_file)
+            coordinates = []
+            stack = [clip]
+            while stack:
+                item = stack.pop()
+                if isinstance(item, dict):
+                    stack.extend(item.values())
+                elif isinstance(item, list):
+                    if len(item) >= 2 and all(isinstance(value, (int, float)) for value in item):
+                        coordinates.append(item)
+                    else:
+                        stack.extend(item)
+            min_lon = min(coordinate[0] for coordinate in coordinates)
+            min_lat = min(coordinate[1] for coordinate in coordinates)
+            max_lon = max(coordinate[0] for coordinate in coordinates)
+            max_lat = max(coordinate[1] for coordinate in coordinates)
+        else:
+            min_lon, min_lat, max_lon, max_lat = [
+                float(value) for value in self.default['IMPORT_SHARD_BBOX'].split(',')]
+
+        shards = int(self.default['IMPORT_SHARDS'])
+        width = (max_lon - min_lon) / shards
+        return [
+            (min_lon + width * index, min_lat,
+             max_lon if index == shards - 1 else min_lon + width * (index + 1), max_lat)
+            for index in range(shards)]
+
+    def _shard_schema(self, index):
+        return '%s_shard_%s' % (self.default['DBSCHEMA_IMPORT'], index)
+
+    def _import_shard(self, index, bbox, args):
+        """Cut a shard of the PBF file and import it in its own schema, with its own cache.
+
+        :return: Time spent to cut and to import the shard, in seconds
+        :rtype: (float, float)
+        """
+        shard_folder = join(self.default['CACHE'], 'shards', str(index))
+        if exists(shard_folder):
+            rmtree(shard_folder)
+        makedirs(shard_folder)
+        shard_file = join(shard_folder, 'shard.pbf')
+
+        start = monotonic()
+        command = ['osmconvert', self.osm_file]
+        command += ['-b=%s,%s,%s,%s' % bbox, '--complete-ways', '--complete-multipolygons']
+        command += ['-o=%s' % shard_file]
+        self.info(command)
+        if not call(command) == 0:
+            self.error('An error occured in osmconvert with the shard %s.' % index)
+        cut_time = monotonic() - start
+
+        start = monotonic()
+        command = self._import_command(
+            shard_file, join(shard_folder, 'cache'), shard_folder, self._shard_schema(index))
+        command.extend(args)
+        self.info(command)
+        if not call(command) == 0:
+            self.error('An error occured in imposm with the shard %s.' % index)
+        import_time = monotonic() - start
+
+        rmtree(shard_folder)
+        return cut_time, import_time
+
+    def _read_diff_cache(self):
+        """Build the cache of the whole PBF file used by the diff imports, without writing."""
+        start = monotonic()
+        command = ['imposm', 'import', '-diff']
+        command += ['-overwritecache', '-cachedir', self.default['CACHE']]
+        command += ['-diffdir', self.default['SETTINGS']]
+        command += ['-mapping', self.mapping_file]
+        command += ['-read', self.osm_file]
+        self.info(command)
+        if not call(command) == 0:
+            self.error('An error occured in imposm while reading the original file.')
+        return monotonic() - start
+
+    def _merge_shards(self):
+        """Merge the tables of the shard schemas into the import schema.
+
+        Features cut by the border of two shards are in both of them, the rows
+        of a shard already merged from the previous shards are skipped. The
+        indexes of the shard tables are built once the rows are merged.
+        """
+        import_schema = self.default['DBSCHEMA_IMPORT']
+        shard_schemas = [self._shard_schema(index) for index in range(int(self.default['IMPORT_SHARDS']))]
+
+        self.cursor.execute('CREATE SCHEMA IF NOT EXISTS "%s"' % import_schema)
+        self.cursor.execute(
+            'SELECT table_name FROM information_schema.tables WHERE table_schema = %s',
+            (shard_schemas[0],))
+        for table_name, in self.cursor.fetchall():
+            start = monotonic()
+            self.cursor.execute(
+                'SELECT column_name FROM information_schema.columns '
+                'WHERE table_schema = %s AND table_name = %s ORDER BY ordinal_position',
+                (shard_schemas[0], table_name))
+            columns = [column for column, in self.cursor.fetchall() if column != 'id']
+            column_list = ', '.join('"%s"' % column for column in columns)
+            target = '"%s"."%s"' % (import_schema, table_name)
+
+            shard_table = '"%s"."%s"' % (shard_schemas[0], table_name)
+
+            self.cursor.execute('DROP TABLE IF EXISTS %s' % target)
+            self.cursor.execute(
+                'CREATE TABLE %s (LIKE %s INCLUDING CONSTRAINTS)' % (target, shard_table))
+            self.cursor.execute(
+                'CREATE SEQUENCE "%s"."%s_id_seq" OWNED BY %s.id' % (import_schema, table_name, target))
+            self.cursor.execute(
+                'ALTER TABLE %s ALTER COLUMN id SET DEFAULT nextval(\'"%s"."%s_id_seq"\')'
+                % (target, import_schema, table_name))
+
+            for shard_schema in shard_schemas:
+                # osm_id is not unique in every table, the members of relations for instance,
+                # so the duplicates are the rows equal on every column.
+                sql = 'INSERT INTO %s (%s) SELECT %s FROM "%s"."%s"' % (
+                    target, column_list, column_list, shard_schema, table_name)
+                if shard_schema != shard_schemas[0]:
+                    sql += ' EXCEPT ALL SELECT %s FROM %s' % (column_list, target)
+                self.cursor.execute(sql)
+
+            self.cursor.execute(
+                'SELECT pg_get_constraintdef(oid) FROM pg_constraint '
+                "WHERE conrelid = %s::regclass AND contype IN ('p', 'u')", (shard_table,))
+            for constraint, in self.cursor.fetchall():
+                self.cursor.execute('ALTER TABLE %s ADD %s' % (target, constraint))
+            self.cursor.execute(
+                'SELECT pg_get_indexdef(indexrelid) FROM pg_index WHERE indrelid = %s::regclass '
+                'AND NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conindid = indexrelid)', (shard_table,))
+            for index, in self.cursor.fetchall():
+                self.cursor.execute(SHARD_INDEX_TABLE.sub(' ON %s USING ' % target, index, count=1))
+            self.cursor.execute('ANALYZE %s' % target)
+            self.info('Merged %s.%s in %.1f seconds' % (import_schema, table_name, monotonic() - start))
+
+        for shard_schema in shard_schemas:
+            self.cursor.execute('DROP SCHEMA IF EXISTS "%s" CASCADE' % shard_schema)
+        self.cursor.connection.commit()
+
+    def _deploy_production(self):
+        """Deploy the import schema into the production schema, in one transaction by imposm."""
+        command = ['imposm', 'import', '-deployproduction'] + self._optimize_args()
+        command += ['-dbschema-production', self.default['DBSCHEMA_PRODUCTION']]
+        command += ['-dbschema-import', self.default['DBSCHEMA_IMPORT']]
+        command += ['-dbschema-backup', self.default['DBSCHEMA_BACKUP']]
+        command += ['-mapping', self.mapping_file]
+        command += ['-connection', self.postgis_uri]
+        self.info(command)
+        if not call(command) == 0:
+            self.error('An error occured in imposm while deploying the import schema.')
+
+    def _sharded_pbf_import(self, args):
+        """Run the first PBF import into the database, with one imposm process per shard.
+
+        The shards are imported in parallel, merged in the import schema and deployed at once.
+        The cache of the whole file, needed for the diffs, is read meanwhile.
+        """
+        self.info('The database is empty. Let\'s import the PBF in %s shards : %s' % (
+            self.default['IMPORT_SHARDS'], self.osm_file))
+        start = monotonic()
+        bboxes = self._shard_bboxes()
+        with ThreadPoolExecutor(max_workers=int(self.default['IMPORT_SHARD_WORKERS']) + 1) as executor:
+            diff_cache = executor.submit(self._read_diff_cache)
+            shards = [
+                executor.submit(self._import_shard, index, bbox, args)
+                for index, bbox in enumerate(bboxes)]
+            for index, shard in enumerate(shards):
+                cut_time, import_time = shard.result()
+                self.info('Shard %s %s : cut in %.1f seconds, imported in %.1f seconds' % (
+                    index, bboxes[index], cut_time, import_time))
+            self.info('Diff cache read in %.1f seconds' % diff_cache.result())
+
+        merge_start = monotonic()
+        self._merge_shards()
+        self.info('Shards merged in %.1f seconds' % (monotonic() - merge_start))
+        self._deploy_production()
+        self.info('Import PBF successful in %.1f seconds : %s' % (monotonic() - start, self.osm_file))
+
+        self._post_pbf_import()
+
+    def _query_with_retry(self, query):
+        """Run query(cursor) in a transaction on a new connection and return its result.
+
+        The queries of the diff loop do not use the long-lived cursor: the query
+        is run again on a new connection while the database is unreachable, so
+        a dropped connection does not stop the import of the diffs.
+        """
+        while True:
+            try:
+                connection = connect(self.conn_parameters)
+                try:
+                    with connection:
+                        with connection.cursor() as cursor:
+                            return query(cursor)
+                finally:
+                    connection.close()
+            except (OperationalError, InterfaceError) as e:
+                self.info('The database is not reachable, retrying in 2 seconds : %s' % e)
+                sleep(2)
+
+    def _clip_table(self):
+        return '"%s"."clip_subdivided"' % self.default['DBSCHEMA_PRODUCTION']
+
+    def _load_clip(self):
+        """Load clip.geojson in the database, subdivided in small polygons with a GiST index.
+
+        The rows written by the diffs are tested against the small polygons,
+        so most of them are accepted by their bounding box alone.
+        """
+        with open(self.clip_json_file) as clip_file:
+            clip = json.load(clip_file)
+        if clip.get('type') == 'FeatureCollection':
+            geometries = [feature['geometry'] for feature in clip['features']]
+        elif clip.get('type') == 'Feature':
+            geometries = [clip['geometry']]
+        else:
+            geometries = [clip]
+
+        clip_table = self._clip_table()
+        self.cursor.execute('DROP TABLE IF EXISTS %s' % clip_table)
+        self.cursor.execute('CREATE TABLE %s (geom geometry(Geometry, %s))' % (clip_table, self.default['SRID']))
+        for geometry in geometries:
+            self.cursor.execute(
+                'INSERT INTO %s (geom) '
+                'SELECT ST_Subdivide(ST_Transform(ST_SetSRID(ST_GeomFromGeoJSON(%%s), 4326), %s), 256)'
+                % (clip_table, self.default['SRID']),
+                (json.dumps(geometry),))
+        self.cursor.execute('CREATE INDEX ON %s USING gist (geom)' % clip_table)
+        self.cursor.execute('ANALYZE %s' % clip_table)
+        self.cursor.connection.commit()
+        self.info('Clip loaded in %s' % clip_table)
+
+    def _clip_checkpoints(self):
+        """Geometry column and highest id of each OSM table before a diff.
+
+        imposm writes the created and the modified features as new rows, so
+        the rows of a diff are the rows above the checkpoint. The geometry
+        column is read from geometry_columns, the mapping can name it.
+        """
+        def read_checkpoints(cursor):
+            cursor.execute(
+                "SELECT tables.table_name, min(geometry_columns.f_geometry_column), "
+                "bool_or(columns.column_name IS NOT NULL) "
+                "FROM information_schema.tables AS tables "
+                "LEFT JOIN geometry_columns ON geometry_columns.f_table_schema = tables.table_schema "
+                "AND geometry_columns.f_table_name = tables.table_name "
+                "LEFT JOIN information_schema.columns AS columns ON columns.table_schema = tables.table_schema "
+                "AND columns.table_name = tables.table_name AND columns.column_name = 'id' "
+                "WHERE tables.table_schema = %s AND tables.table_name LIKE 'osm\\_%%' "
+                "AND tables.table_type = 'BASE TABLE' "
+                "GROUP BY tables.table_name",
+                (self.default['DBSCHEMA_PRODUCTION'],))
+            checkpoints = {}
+            for table_name, geometry_column, has_id in cursor.fetchall():
+                if not geometry_column or not has_id:
+                    if table_name not in self.unclipped_tables:
+                        self.unclipped_tables.add(table_name)
+                        self.info('Clip : %s is not clipped, it has no id or no geometry column' % table_name)
+                    continue
+                cursor.execute(
+                    'SELECT coalesce(max(id), 0) FROM "%s"."%s"' % (self.default['DBSCHEMA_PRODUCTION'], table_name))
+                checkpoints[table_name] = (geometry_column, cursor.fetchone()[0])
+            return checkpoints
+
+        return self._query_with_retry(read_checkpoints)
+
+    def _clip_rows(self, table_name, geometry_column, checkpoint):
+        """Delete the rows of a table above the checkpoint which are outside the clip.
+
+        :return: Number of removed rows and time spent, in seconds
+        :rtype: (int, float)
+        """
+        start = monotonic()
+
+        def delete_rows(cursor):
+            cursor.execute(
+                'DELETE FROM "%s"."%s" AS osm WHERE osm.id > %%s AND NOT EXISTS ('
+                'SELECT 1 FROM %s AS clip '
+                'WHERE clip.geom && osm."%s" AND ST_Intersects(clip.geom, osm."%s"))'
+                % (self.default['DBSCHEMA_PRODUCTION'], table_name, self._clip_table(),
+                   geometry_column, geometry_column),
+                (checkpoint,))
+            return cursor.rowcount
+
+        removed = self._query_with_retry(delete_rows)
+        return removed, monotonic() - start
+
+    def _enforce_clip(self, checkpoints):
+        """Remove the rows of the last diffs outside the clip, a table by worker connection.
+
+        imposm -limitto keeps the features close to the clip, this removes the ones outside.
+        """
+        start = monotonic()
+        removed_rows = 0
+        with ThreadPoolExecutor(max_workers=int(self.default['CLIP_WORKERS'])) as executor:
+            tables = dict(
+                (table_name, executor.submit(self._clip_rows, table_name, geometry_column, checkpoint))
+                for table_name, (geometry_column, checkpoint) in checkpoints.items())
+            for table_name, table in sorted(tables.items()):
+                removed, elapsed = table.result()
+                removed_rows += removed
+                if removed:
+                    self.info('Clip %s : %s rows removed in %.2f seconds' % (table_name, removed, elapsed))
+        self.metrics.observe('docker_osm_clip_seconds', monotonic() - start)
+        self.metrics.inc('docker_osm_clip_removed_rows_total', removed_rows)
+        self.info('Clip : %s rows removed in %.2f seconds' % (removed_rows, monotonic() - start))
+
+    def _start_vacuum_worker(self):
+        """Vacuum the tables queued by the diffs in a background thread."""
+        self.vacuum_queue = Queue()
+        Thread(target=self._vacuum_worker, daemon=True).start()
+
+    def _vacuum_worker(self):
+        connection = None
+        while True:
+            schema, table_name = self.vacuum_queue.get()
+            start = monotonic()
+            try:
+                if connection is None or connection.closed:
+                    connection = connect(self.conn_parameters)
+                    connection.autocommit = True
+                with connection.cursor() as cursor:
+                    cursor.execute('VACUUM (ANALYZE) "%s"."%s"' % (schema, table_name))
+                self.metrics.observe('docker_osm_vacuum_seconds', monotonic() - start)
+                self.metrics.inc('docker_osm_vacuums_total')
+                self.info('Vacuumed %s.%s in %.1f seconds' % (schema, table_name, monotonic() - start))
+            except Error as e:
+                self.info('Can not vacuum %s.%s : %s' % (schema, table_name, e))
+                if connection is not None:
+                    connection.close()
+            finally:
+                with self.vacuum_lock:
+                    self.vacuum_pending.discard((schema, table_name))
+
+    def _track_churn(self):
+        """Queue a VACUUM (ANALYZE) of the tables changed a lot since their last one.
+
+        The churn of a table is the number of rows inserted, updated and
+        deleted, from pg_stat_user_tables, since the importer started or last
+        vacuumed it. It is compared to VACUUM_CHURN_ROWS plus
+        VACUUM_CHURN_RATIO times the live rows of the table.
+        """
+        def read_churn(cursor):
+            cursor.execute(
+                'SELECT schemaname, relname, n_tup_ins + n_tup_upd + n_tup_del, n_live_tup '
+                'FROM pg_stat_user_tables WHERE schemaname IN (%s, %s)',
+                (self.default['DBSCHEMA_PRODUCTION'], 'materialized_views'))
+            return cursor.fetchall()
+
+        tables = self._query_with_retry(read_churn)
+
+        churn_rows = int(self.default['VACUUM_CHURN_ROWS'])
+        churn_ratio = float(self.default['VACUUM_CHURN_RATIO'])
+        for schema, table_name, changes, live_rows in tables:
+            table = (schema, table_name)
+            baseline = self.churn_baseline.setdefault(table, changes)
+            if changes < baseline:
+                # The statistics were reset.
+                self.churn_baseline[table] = baseline = changes
+            if changes - baseline < churn_rows + churn_ratio * live_rows:
+                continue
+            with self.vacuum_lock:
+                if table in self.vacuum_pending:
+                    continue
+                self.vacuum_pending.add(table)
+            self.info('Queueing a vacuum of %s.%s, %s rows changed' % (schema, table_name, changes - baseline))
+            self.churn_baseline[table] = changes
+            self.vacuum_queue.put(table)
+
+    def _next_diff_batch(self, import_queue):
+        """Take the next diffs of the queue to import in one imposm call.
+
+        The batch is bounded by DIFF_BATCH_COUNT files and DIFF_BATCH_BYTES
+        bytes, but it always contains at least one file.
+        """
+        max_count = int(self.default['DIFF_BATCH_COUNT'])
+        max_bytes = int(self.default['DIFF_BATCH_BYTES'])
+        batch = []
+        batch_bytes = 0
+        for diff in import_queue:
+            diff_bytes = getsize(join(self.default['IMPORT_QUEUE'], diff))
+            if batch and (len(batch) >= max_count or batch_bytes + diff_bytes > max_bytes):
+                break
+            batch.append(diff)
+            batch_bytes += diff_bytes
+        return batch
+
+    def _list_import_queue(self):
+        """List the diffs of the queue, sorted, without the partial files.
+
+        The partial files are hidden until they are renamed when complete.
+        """
+        return sorted(
+            diff for diff in listdir(self.default['IMPORT_QUEUE'])
+            if not diff.startswith('.'))
+
+    def _watch_import_queue(self):
+        """Watch the queue for new diffs if inotify is available."""
+        if INotify is None:
+            self.info('inotify is not available, polling the queue every %s seconds.' % self.default['TIME'])
+            return
+        try:
+            self.queue_watcher = INotify()
+            self.queue_watcher.add_watch(
+                self.default['IMPORT_QUEUE'], flags.MOVED_TO | flags.CLOSE_WRITE)
+        except OSError as e:
+            self.info('Can not watch %s, polling instead : %s' % (self.default['IMPORT_QUEUE'], e))
+            self.queue_watcher = None
+
+    def _wait_for_diff(self):
+        """Wait until a new diff arrives in the queue or TIME seconds."""
+        if self.queue_watcher is None:
+            self.info('Sleeping for %s seconds.' % self.default['TIME'])
+            sleep(float(self.default['TIME']))
+        else:
+            self.info('Waiting for a new diff, at most %s seconds.' % self.default['TIME'])
+            self.queue_watcher.read(timeout=int(float(self.default['TIME']) * 1000))
+
     def _import_diff(self, args):
         # Finally launch the listening process.
+        self.backfill_manifest()
+        self._watch_import_queue()
+        clip = self.default['CLIP'] == 'yes'
+        if clip:
+            self._load_clip()
+        vacuum = self.default['VACUUM_AFTER_DIFFS'] == 'yes'
+        if vacuum:
+            self._start_vacuum_worker()
         while True:
-            import_queue = sorted(listdir(self.default['IMPORT_QUEUE']))
-            if len(import_queue) > 0:
-                for diff in import_queue:
-                    self.info('Importing diff %s' % diff)
-                    command = ['imposm', 'diff']
-                    command += ['-cachedir', self.default['CACHE']]
-                    command += ['-dbschema-production', self.default['DBSCHEMA_PRODUCTION']]
-                    command += ['-dbschema-import', self.default['DBSCHEMA_IMPORT']]
-                    command += ['-dbschema-backup', self.default['DBSCHEMA_BACKUP']]
-                    command += ['-srid', self.default['SRID']]
-                    command += ['-diffdir', self.default['SETTINGS']]
-                    command += ['-mapping', self.mapping_file]
-                    command += ['-connection', self.postgis_uri]
-                    command.extend(args)
-                    command += [join(self.default['IMPORT_QUEUE'], diff)]
-
-                    self.info(command)
-                    if call(command) == 0:
+            import_queue = self._list_import_queue()
+            while len(import_queue) > 0:
+                diffs = self._next_diff_batch(import_queue)
+                import_queue = import_queue[len(diffs):]
+                self.info('Importing diff %s' % ', '.join(diffs))
+                command = ['imposm', 'diff']
+                command += ['-cachedir', self.default['CACHE']]
+                command += ['-dbschema-production', self.default['DBSCHEMA_PRODUCTION']]
+                command += ['-dbschema-import', self.default['DBSCHEMA_IMPORT']]
+                command += ['-dbschema-backup', self.default['DBSCHEMA_BACKUP']]
+                command += ['-srid', self.default['SRID']]
+                command += ['-diffdir', self.default['SETTINGS']]
+                command += ['-mapping', self.mapping_file]
+                command += ['-connection', self.postgis_uri]
+                command.extend(args)
+                command += [join(self.default['IMPORT_QUEUE'], diff) for diff in diffs]
+
+                self.info(command)
+                if clip:
+                    checkpoints = self._clip_checkpoints()
+                start = monotonic()
+                if call(command) == 0:
+                    elapsed = monotonic() - start
+                    if clip:
+                        self._enforce_clip(checkpoints)
+                    self.metrics.observe('docker_osm_imposm_diff_batch_seconds', elapsed)
+                    for diff in diffs:
+                        self.metrics.observe('docker_osm_imposm_diff_seconds', elapsed / len(diffs))
+                        self.metrics.inc('docker_osm_diffs_imported_total')
+                        self.metrics.inc(
+                            'docker_osm_diff_import_bytes_total', getsize(join(self.default['IMPORT_QUEUE'], diff)))
                         move(
                             join(self.default['IMPORT_QUEUE'], diff),
                             join(self.default['IMPORT_DONE'], diff))
 
-                        # Update the timestamp in the file.
-                        database_timestamp = diff.split('.')[0].split('->-')[1]
-                        self.update_timestamp(database_timestamp)
-                    else:
-                        msg = 'An error occured in imposm with a diff.'
-                        self.error(msg)
+                    # Update the timestamp in the file with the newest diff.
+                    database_timestamp = diffs[-1].split('.')[0].split('->-')[1]
+                    self.update_timestamp(database_timestamp)
+                    self.update_manifest(diffs)
+                    if vacuum:
+                        self._track_churn()
+                else:
+                    msg = 'An error occured in imposm with a diff.'
+                    self.error(msg)
 
-            if len(listdir(self.default['IMPORT_QUEUE'])) == 0:
-                self.info('Sleeping for %s seconds.' % self.default['TIME'])
-                sleep(float(self.default['TIME']))
+            if len(self._list_import_queue()) == 0:
+                self._wait_for_diff()
 
 
 if __name__ == '__main__':
@@ -389,5 +1400,6 @@ if __name__ == '__main__':
     importer.overwrite_environment()
     importer.check_settings()
     importer.create_timestamp()
+    importer.start_metrics()
     importer.check_postgis()
     importer.run()
@@ -0,0 +1,83 @@
+from importer import Importer, split_sql
+
+
+def statements(sections):
+    return [statement for parallel, section in sections for statement in section]
+
+
+def test_split_sql_statements():
+    sections = split_sql("CREATE TABLE a (id int);\nINSERT INTO a VALUES (1);\n")
+    assert sections == [(False, ['CREATE TABLE a (id int)', 'INSERT INTO a VALUES (1)'])]
+
+
+def test_split_sql_keeps_semicolons_in_quotes_and_comments():
+    sections = split_sql(
+        "-- a comment; not a statement\n"
+        "SELECT 'a;b';\n"
+        "CREATE FUNCTION f() RETURNS int AS $body$ SELECT 1; $body$ LANGUAGE sql;\n")
+    found = statements(sections)
+    assert len(found) == 2
+    assert "'a;b'" in found[0]
+    assert '$body$ SELECT 1; $body$' in found[1]
+
+
+def test_split_sql_parallel_sections():
+    sections = split_sql(
+        "CREATE TABLE a (id int);\n"
+        "-- @parallel\n"
+        "CREATE INDEX ON a (id);\n"
+        "ANALYZE a;\n"
+        "-- @end parallel\n"
+        "DROP TABLE a;\n")
+    assert [parallel for parallel, section in sections] == [False, True, False]
+    assert len(sections[1][1]) == 2
+
+
+def test_split_sql_copy_keeps_its_data():
+    sections = split_sql(
+        "COPY public.a (id, name) FROM stdin;\n"
+        "1\tone;two\n"
+        "\\.\n"
+        "SELECT 1;\n")
+    found = statements(sections)
+    assert len(found) == 2
+    assert found[0].startswith('COPY public.a (id, name) FROM stdin;\n')
+    assert '1\tone;two' in found[0]
+    assert found[1] == 'SELECT 1'
+
+
+def test_split_sql_skips_psql_meta_commands():
+    assert statements(split_sql("\\connect gis\nSELECT 1;\n")) == ['SELECT 1']
+
+
+def write_diffs(folder, sizes):
+    names = []
+    for index, size in enumerate(sizes):
+        name = '2020-01-0%sT00:00:00Z->-2020-01-0%sT00:00:00Z.osc.gz' % (index + 1, index + 2)
+        with open(str(folder.join(name)), 'wb') as diff:
+            diff.write(b'0' * size)
+        names.append(name)
+    return names
+
+
+def create_importer(folder, count, size):
+    importer = Importer()
+    importer.default['IMPORT_QUEUE'] = str(folder)
+    importer.default['DIFF_BATCH_COUNT'] = str(count)
+    importer.default['DIFF_BATCH_BYTES'] = str(size)
+    return importer
+
+
+def test_next_diff_batch_bounded_by_count(tmpdir):
+    diffs = write_diffs(tmpdir, [10, 10, 10])
+    assert create_importer(tmpdir, 2, 1000)._next_diff_batch(diffs) == diffs[:2]
+
+
+def test_next_diff_batch_bounded_by_bytes(tmpdir):
+    diffs = write_diffs(tmpdir, [10, 10, 10])
+    assert create_importer(tmpdir, 10, 25)._next_diff_batch(diffs) == diffs[:2]
+
+
+def test_next_diff_batch_takes_a_large_diff_alone(tmpdir):
+    diffs = write_diffs(tmpdir, [100, 10])
+    assert create_importer(tmpdir, 10, 25)._next_diff_batch(diffs) == diffs[:1]
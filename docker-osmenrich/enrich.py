@@ -20,18 +20,130 @@
 """
 
 import gzip
+import sqlite3
 import sys
-from os import environ, listdir, mkdir
+from array import array
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from heapq import merge
+from mmap import mmap, ACCESS_READ
+from os import environ, listdir, mkdir, remove, replace, rmdir
 from os.path import join, exists, getsize
 from sys import exit, stderr
-from time import sleep
-from urllib import request
-from datetime import timezone
+from threading import Lock, local
+from time import sleep, monotonic
+from urllib.parse import urlsplit
+from datetime import datetime, timezone
+from xml.etree.ElementTree import iterparse
 
 import xmltodict
 import yaml
 from dateutil import parser
-from psycopg2 import connect, OperationalError, ProgrammingError
+from psycopg2 import Error, OperationalError, ProgrammingError, InterfaceError
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+
+from manifest import MANIFEST_SCHEMA
+from mapping import find_mapping_file
+from metrics import Metrics
+
+# Metrics of enrich.
+METRICS = {
+    'docker_osm_enrich_elements_total': ('counter', 'Number of osm elements read from the diffs.'),
+    'docker_osm_enrich_elements_per_second': ('gauge', 'Osm elements enriched per second by the latest run.'),
+    'docker_osm_diffs_enriched_total': ('counter', 'Number of enriched diffs.'),
+    'docker_osm_db_round_trips_total': ('counter', 'Number of queries sent to the database.'),
+    'docker_osm_api_calls_total': ('counter', 'Number of requests sent to the OSM API.'),
+    'docker_osm_api_errors_total': ('counter', 'Number of failed or throttled requests to the OSM API.')
+}
+
+
+class MappingLoader(yaml.SafeLoader):
+    """YAML loader of the imposm mapping.
+
+    imposm reads the values of the mapping as strings, so yes, no, true and
+    false are kept as written instead of being read as booleans.
+    """
+
+
+MappingLoader.yaml_implicit_resolvers = dict(
+    (first, [resolver for resolver in resolvers if resolver[0] != 'tag:yaml.org,2002:bool'])
+    for first, resolvers in yaml.SafeLoader.yaml_implicit_resolvers.items())
+
+
+class OsmIdIndex(object):
+    """Sorted set of osm ids persisted in a binary file.
+
+    The ids are held in memory as a sorted array of 64 bits integers, so the
+    membership check costs no I/O. New ids are kept aside until the index
+    is flushed, which appends them to a log file next to the sorted file.
+    The log is merged into the sorted file, rewritten atomically, once it
+    holds more than a share of the ids, so a flush costs the new ids only.
+    """
+
+    # The log is merged when it holds more ids than both of them.
+    merge_min_ids = 65536
+    merge_ratio = 0.1
+
+    def __init__(self, path):
+        self.path = path
+        self.log_path = path + '.log'
+        self.ids = array('q')
+        self.logged_ids = set()
+        self.new_ids = set()
+        if exists(path) and getsize(path) > 0:
+            with open(path, 'rb') as f:
+                with mmap(f.fileno(), 0, access=ACCESS_READ) as content:
+                    self.ids.frombytes(content)
+        if exists(self.log_path):
+            logged_ids = array('q')
+            with open(self.log_path, 'rb') as f:
+                # An id cut by a crash while appending is dropped.
+                content = f.read()
+                logged_ids.frombytes(content[:len(content) - len(content) % logged_ids.itemsize])
+            # The log may be merged already if the merge stopped before removing it.
+            self.logged_ids = set(osm_id for osm_id in logged_ids if not self._in_sorted_ids(osm_id))
+
+    def _in_sorted_ids(self, osm_id):
+        index = bisect_left(self.ids, osm_id)
+        return index < len(self.ids) and self.ids[index] == osm_id
+
+    def __contains__(self, osm_id):
+        if self._in_sorted_ids(osm_id):
+            return True
+        return osm_id in self.logged_ids or osm_id in self.new_ids
+
+    def __len__(self):
+        return len(self.ids) + len(self.logged_ids) + len(self.new_ids)
+
+    def add(self, osm_id):
+        if osm_id not in self:
+            self.new_ids.add(osm_id)
+
+    def flush(self):
+        """Append the new ids to the log, and merge the log when it is large."""
+        if not self.new_ids:
+            return
+        with open(self.log_path, 'ab') as f:
+            array('q', self.new_ids).tofile(f)
+        self.logged_ids.update(self.new_ids)
+        self.new_ids = set()
+        if len(self.logged_ids) > max(self.merge_min_ids, len(self.ids) * self.merge_ratio):
+            self.merge()
+
+    def merge(self):
+        """Merge the logged ids into the sorted array and rewrite the file."""
+        self.ids = array('q', merge(self.ids, sorted(self.logged_ids)))
+        self.logged_ids = set()
+        with open(self.path + '.tmp', 'wb') as f:
+            self.ids.tofile(f)
+        replace(self.path + '.tmp', self.path)
+        remove(self.log_path)
+
 
 class Enrich(object):
     mapping_type = {
@@ -39,6 +151,7 @@ class Enrich(object):
         'linestring': 'way',
         'polygon': 'way'
     }
+    osm_data_types = ('node', 'way', 'relation')
     enriched_column = {
         'changeset_id': 'int',
         'changeset_version': 'int',
@@ -48,6 +161,7 @@ class Enrich(object):
     latest_diff_file = None
     cache_folder = None
     out_of_scope_osm_folder = None
+    out_of_scope_osm_ids = {}
 
     def __init__(self):
         # Default values which can be overwritten by environment variable.
@@ -62,9 +176,17 @@ class Enrich(object):
             'OSM_API_URL': 'https://api.openstreetmap.org/api/0.6/',
             'IMPORT_DONE': 'import_done',
             'CACHE': 'cache',
-            'MAX_DIFF_FILE_SIZE': 100000000,
             'DBSCHEMA_PRODUCTION': 'public',
             'CACHE_MODIFY_CHECK': '',
+            'CACHE_MODIFY_MIGRATE': '',
+            'ENRICH_BATCH_SIZE': 1000,
+            'DIFF_WORKERS': 1,
+            'DB_POOL_SIZE': 4,
+            'API_BATCH_SIZE': 30,
+            'API_WORKERS': 4,
+            'API_RATE_LIMIT': 0,
+            'API_MAX_RETRY': 3,
+            'METRICS_PORT': '9898',
             'SSL_MODE': 'disable',
             'SSL_CERT': None,
             'SSL_ROOT_CERT': None,
@@ -72,7 +194,16 @@ class Enrich(object):
         }
         self.mapping_file = None
         self.mapping_database_schema = {}
+        self.table_routes = {}
+        self.table_filters = {}
         self.postgis_uri = None
+        self.enrich_batch = {}
+        self.connection_pool = None
+        self.manifest = None
+        self.api_connection = local()
+        self.api_lock = Lock()
+        self.api_next_request = 0
+        self.metrics = None
         self.overwrite_environment()
         self.check_settings()
 
@@ -84,9 +215,7 @@ class Enrich(object):
         """
         # Test files
         try:
-            for f in listdir(self.default['SETTINGS']):
-                if f.endswith('.yml'):
-                    self.mapping_file = join(self.default['SETTINGS'], f)
+            self.mapping_file = find_mapping_file(self.default['SETTINGS'], ('.yml',))
         except FileNotFoundError:
             pass
 
@@ -108,12 +237,9 @@ class Enrich(object):
             if not exists(cache_folder):
                 mkdir(cache_folder)
 
-            # out_of_scope_osm
-            out_of_scope_osm_folder = join(
+            # out_of_scope_osm, marker files of the previous versions
+            self.out_of_scope_osm_folder = join(
                 cache_folder, 'out_of_scope_osm')
-            if not exists(out_of_scope_osm_folder):
-                mkdir(out_of_scope_osm_folder)
-            self.out_of_scope_osm_folder = out_of_scope_osm_folder
 
         self.cache_folder = cache_folder
 
@@ -123,6 +249,19 @@ class Enrich(object):
         else:
             self.default['CACHE_MODIFY_CHECK'] = False
 
+        if self.default['CACHE_MODIFY_CHECK'] and exists(self.cache_folder):
+            self.out_of_scope_osm_ids = {}
+            for osm_type in self.osm_data_types:
+                self.out_of_scope_osm_ids[osm_type] = OsmIdIndex(
+                    join(self.cache_folder, 'out_of_scope_%s.bin' % osm_type))
+            if self.default['CACHE_MODIFY_MIGRATE'].lower() == 'true':
+                self.migrate_non_recognized_id_folder()
+
+    def start_metrics(self):
+        """Serve the metrics of enrich."""
+        self.metrics = Metrics('osmenrich', METRICS, self.default['SETTINGS'])
+        self.metrics.start(self.default['METRICS_PORT'])
+
     def get_cache_path(self):
         return join(self.cache_folder, 'cache')
 
@@ -143,29 +282,48 @@ class Enrich(object):
         if not self.default['CACHE_MODIFY_CHECK']:
             return False
 
-        if self.out_of_scope_osm_folder:
-            if exists(
-                    join(self.out_of_scope_osm_folder,
-                         '%s-%s' % (osm_type, osm_id))):
-                return True
+        out_of_scope_osm_ids = self.check_data_on_dict(self.out_of_scope_osm_ids, osm_type)
+        if out_of_scope_osm_ids is not None:
+            return int(osm_id) in out_of_scope_osm_ids
         return False
 
     def get_or_create_non_recognized_id(self, osm_type, osm_id):
-        """ Create file as cache for non recognized id
+        """ Add osm id in cache of non recognized id
         """
         if not self.default['CACHE_MODIFY_CHECK']:
             return
 
-        if self.out_of_scope_osm_folder:
-            filename = join(
-                self.out_of_scope_osm_folder,
-                '%s-%s' % (osm_type, osm_id))
-            if not exists(filename):
-                try:
-                    f = open(filename, 'w+')
-                    f.close()
-                except IOError:
-                    self.info('%s can\'t be created' % filename)
+        out_of_scope_osm_ids = self.check_data_on_dict(self.out_of_scope_osm_ids, osm_type)
+        if out_of_scope_osm_ids is not None:
+            out_of_scope_osm_ids.add(int(osm_id))
+
+    def flush_non_recognized_ids(self):
+        """ Write cache of non recognized id into files
+        """
+        for osm_type, out_of_scope_osm_ids in self.out_of_scope_osm_ids.items():
+            try:
+                out_of_scope_osm_ids.flush()
+            except (IOError, OSError):
+                self.info('%s can\'t be created' % out_of_scope_osm_ids.path)
+
+    def migrate_non_recognized_id_folder(self):
+        """ Move marker files of non recognized id into cache files
+        """
+        if not self.out_of_scope_osm_folder or not exists(self.out_of_scope_osm_folder):
+            return
+        self.info('Migrate %s' % self.out_of_scope_osm_folder)
+        filenames = listdir(self.out_of_scope_osm_folder)
+        for filename in filenames:
+            try:
+                osm_type, osm_id = filename.split('-', 1)
+                self.get_or_create_non_recognized_id(osm_type, int(osm_id))
+            except ValueError:
+                self.info('%s is not recognized' % filename)
+        self.flush_non_recognized_ids()
+        for filename in filenames:
+            remove(join(self.out_of_scope_osm_folder, filename))
+        rmdir(self.out_of_scope_osm_folder)
+        self.info('Migrated %s osm ids' % len(filenames))
 
     def check_mapping_file_data(self):
         """Perform converting yaml data into json
@@ -173,7 +331,7 @@ class Enrich(object):
         """
         self.info('Load Mapping file data.')
         document = open(self.mapping_file, 'r')
-        mapping_data = yaml.safe_load(document)
+        mapping_data = yaml.load(document, Loader=MappingLoader)
         try:
             for table, value in mapping_data['tables'].items():
                 try:
@@ -198,6 +356,8 @@ class Enrich(object):
                             'osm_id_columnn_index': osm_id_column_index,
                             'columns': columns
                         }
+                        if osm_id_column is not None:
+                            self.add_table_routes('osm_%s' % table, osm_type, value)
                     except KeyError:
                         self.info('Type %s is not yet recognized by enrich.' % type)
                 except KeyError:
@@ -210,7 +370,102 @@ class Enrich(object):
                 'Mapping file %s doesn\'t has "tables" attribute' % self.mapping_file
             )
 
-    def create_connection(self):
+    @staticmethod
+    def get_mapping_values(values):
+        """ Return the values of a tag filter of the mapping as strings,
+        matched literally like imposm does.
+        """
+        return set('%s' % value for value in values or ['__any__'])
+
+    def add_table_routes(self, table, osm_type, table_mapping):
+        """ Index the table by the tags of its mapping, so an osm data
+        is only looked up in the tables it can be in.
+
+        :param table: Table name in the database
+        :type table: str
+
+        :param osm_type: feature type of the table
+        :type osm_type: str
+
+        :param table_mapping: Table in the mapping file
+        :type table_mapping: dict
+        """
+        routes = self.table_routes.setdefault(
+            osm_type, {'all': set(), 'any': set(), 'keys': {}, 'values': {}})
+        routes['all'].add(table)
+
+        mappings = []
+        if table_mapping.get('mapping'):
+            mappings.append(table_mapping['mapping'])
+        for sub_mapping in (table_mapping.get('mappings') or {}).values():
+            mappings.append(sub_mapping.get('mapping') or {})
+        type_mapping = (table_mapping.get('type_mappings') or {}).get('%ss' % table_mapping['type'])
+        if type_mapping:
+            mappings.append(type_mapping)
+        if not mappings:
+            routes['any'].add(table)
+
+        for mapping in mappings:
+            for key, values in mapping.items():
+                if key == '__any__':
+                    routes['any'].add(table)
+                    continue
+                for value in self.get_mapping_values(values):
+                    if value == '__any__':
+                        routes['keys'].setdefault(key, set()).add(table)
+                    else:
+                        routes['values'].setdefault((key, value), set()).add(table)
+
+        filters = table_mapping.get('filters') or {}
+        self.table_filters[table] = tuple(
+            dict(
+                (key, self.get_mapping_values(values))
+                for key, values in (filters.get(name) or {}).items())
+            for name in ('require', 'reject'))
+
+    def match_table_filters(self, table, tags):
+        """ Return if the tags pass the require and reject filters of the table
+        """
+        require, reject = self.table_filters.get(table, ({}, {}))
+        for key, values in require.items():
+            if '__nil__' in values:
+                continue
+            if key not in tags or ('__any__' not in values and tags[key] not in values):
+                return False
+        for key, values in reject.items():
+            if key in tags and ('__any__' in values or tags[key] in values):
+                return False
+        return True
+
+    def get_tables_of_osm_data(self, osm_data_type, osm_data):
+        """ Return the tables that can contain the osm data, from its tags.
+        Every table of the osm type is returned when the tags are unknown.
+
+        :param osm_data_type: feature type of this osm
+        :type osm_data_type: str
+
+        :param osm_data: Data that got from osm, in xmltodict format
+        :type osm_data: dict
+
+        :rtype: set
+        """
+        routes = self.table_routes.get(osm_data_type)
+        if not routes:
+            return set()
+        tags = osm_data.get('tag')
+        if tags is None:
+            return routes['all']
+        if isinstance(tags, dict):
+            tags = [tags]
+        tags = dict((tag['@k'], tag['@v']) for tag in tags)
+
+        tables = set(routes['any'])
+        for key, value in tags.items():
+            tables.update(routes['keys'].get(key, ()))
+            tables.update(routes['values'].get((key, value), ()))
+        return set(table for table in tables if self.match_table_filters(table, tags))
+
+    def get_connection_parameters(self):
         if self.default['SSL_MODE'] == 'verify-ca' or self.default['SSL_MODE'] == 'verify-full':
             if self.default['SSL_CERT'] is None and self.default['SSL_KEY'] is None and self.default['SSL_ROOT_CERT'] \
                     is None:
@@ -237,44 +492,93 @@ class Enrich(object):
                 self.default['POSTGRES_PASS'],
                 self.default['SSL_MODE'])
 
-        return connect(conn_parameters)
+        return conn_parameters
 
-    def check_database(self):
-        """Test connection to PostGIS and create the URI."""
+    def create_connection_pool(self):
+        """Create the pool of connections used for the lifetime of the process."""
+        self.connection_pool = ThreadedConnectionPool(
+            1, int(self.default['DB_POOL_SIZE']), self.get_connection_parameters())
+
+    @staticmethod
+    def is_connection_healthy(connection):
+        """Check without a round-trip that the connection is still usable."""
+        return not connection.closed and \
+            connection.get_transaction_status() != TRANSACTION_STATUS_UNKNOWN
+
+    @contextmanager
+    def borrow_connection(self):
+        """Borrow a healthy connection from the pool and give it back after use.
+
+        A broken connection is discarded from the pool, so the next borrow
+        reconnects to the database.
+        """
+        connection = None
+        for attempt in range(3):
+            try:
+                if not self.connection_pool or self.connection_pool.closed:
+                    self.create_connection_pool()
+                connection = self.connection_pool.getconn()
+            except OperationalError as e:
+                self.info('Can not connect to the database: %s' % e)
+                sleep(2.0)
+                continue
+            if self.is_connection_healthy(connection):
+                break
+            self.connection_pool.putconn(connection, close=True)
+            connection = None
+        if connection is None:
+            raise OperationalError('No healthy connection available in the pool')
+
+        broken = False
         try:
-            connection = self.create_connection()
-            cursor = connection.cursor()
-        except OperationalError as e:
-            print(e)
+            yield connection
+        except (OperationalError, InterfaceError):
+            broken = True
+            raise
+        finally:
+            broken = broken or not self.is_connection_healthy(connection)
+            if not broken and connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                connection.rollback()
+            self.connection_pool.putconn(connection, close=broken)
+
+    def check_database(self):
+        """Test connection to PostGIS and create the URI.
+
+        A connection broken meanwhile is discarded from the pool by
+        borrow_connection, the check is retried by the next loop of run.
+        """
         try:
-            for table, table_data in self.mapping_database_schema.items():
-                new_columns_postgis = []
-                for enrich_key, enrich_type in self.enriched_column.items():
-                    check_column = ''' SELECT EXISTS (SELECT 1 FROM information_schema.columns 
-                                                                WHERE table_name='%s' and column_name='%s'); ''' % (
-                        table, enrich_key)
-                    cursor.execute(check_column)
-                    column_existence = cursor.fetchone()[0]
-
-                    if column_existence != 1:
-                        if enrich_type == 'int':
-                            new_columns_postgis.append('ADD COLUMN IF NOT EXISTS %s NUMERIC' % enrich_key)
-                        elif enrich_type == 'string':
-                            new_columns_postgis.append(
-                                'ADD COLUMN IF NOT EXISTS %s CHARACTER VARYING (255)' % enrich_key)
-                        elif enrich_type == 'datetime':
-                            new_columns_postgis.append('ADD COLUMN IF NOT EXISTS %s TIMESTAMPTZ' % enrich_key)
-
-                if len(new_columns_postgis) > 0:
-                    query = 'ALTER TABLE %s."%s" %s;' % (
-                        self.default['DBSCHEMA_PRODUCTION'], table, ','.join(new_columns_postgis))
-                    cursor.execute(query)
-                    connection.commit()
-            connection.close()
-            return True
-        except (OperationalError, ProgrammingError):
-            connection.rollback()
-            connection.close()
+            with self.borrow_connection() as connection:
+                cursor = connection.cursor()
+                for table, table_data in self.mapping_database_schema.items():
+                    new_columns_postgis = []
+                    for enrich_key, enrich_type in self.enriched_column.items():
+                        check_column = ''' SELECT EXISTS (SELECT 1 FROM information_schema.columns 
+                                                                    WHERE table_name='%s' and column_name='%s'); ''' % (
+                            table, enrich_key)
+                        cursor.execute(check_column)
+                        self.metrics.inc('docker_osm_db_round_trips_total')
+                        column_existence = cursor.fetchone()[0]
+
+                        if column_existence != 1:
+                            if enrich_type == 'int':
+                                new_columns_postgis.append('ADD COLUMN IF NOT EXISTS %s NUMERIC' % enrich_key)
+                            elif enrich_type == 'string':
+                                new_columns_postgis.append(
+                                    'ADD COLUMN IF NOT EXISTS %s CHARACTER VARYING (255)' % enrich_key)
+                            elif enrich_type == 'datetime':
+                                new_columns_postgis.append('ADD COLUMN IF NOT EXISTS %s TIMESTAMPTZ' % enrich_key)
+
+                    if len(new_columns_postgis) > 0:
+                        query = 'ALTER TABLE %s."%s" %s;' % (
+                            self.default['DBSCHEMA_PRODUCTION'], table, ','.join(new_columns_postgis))
+                        cursor.execute(query)
+                        self.metrics.inc('docker_osm_db_round_trips_total')
+                        connection.commit()
+                return True
+        except (OperationalError, InterfaceError, ProgrammingError) as e:
+            # The transaction is rolled back by borrow_connection.
+            self.info('%s' % e)
             return False
 
     @staticmethod
@@ -337,7 +641,8 @@ class Enrich(object):
         return new_data
 
     def update_enrich_into_database(self, table_name, osm_id_column, osm_id, new_data):
-        """ Update new data into data of osm id
+        """ Queue new data of osm id to be updated in batch.
+        The batch of the table is written when it reaches ENRICH_BATCH_SIZE.
 
         :param table_name: Table source of rows
         :type table_name: str
@@ -353,28 +658,149 @@ class Enrich(object):
         """
         if not new_data:
             return
-        sets = []
-        for field, value in new_data.items():
+        batch = self.enrich_batch.setdefault((table_name, osm_id_column), {})
+        current_data = self.check_data_on_dict(batch, osm_id)
+        if not current_data or current_data['changeset_timestamp'] < new_data['changeset_timestamp']:
+            batch[osm_id] = new_data
+        if len(batch) >= int(self.default['ENRICH_BATCH_SIZE']):
+            self.flush_enrich_into_database(table_name, osm_id_column)
+
+    def flush_enrich_into_database(self, table_name=None, osm_id_column=None):
+        """ Write queued new data into database with one update per table.
+        If table_name is None, every queued table is written.
+
+        :param table_name: Table source of rows
+        :type table_name: str
+
+        :param osm_id_column: Column name of osm_id
+        :type osm_id_column: str
+        """
+        if table_name:
+            keys = [(table_name, osm_id_column)]
+        else:
+            keys = list(self.enrich_batch.keys())
+
+        for table_name, osm_id_column in keys:
+            batch = self.enrich_batch.pop((table_name, osm_id_column), None)
+            if not batch:
+                continue
+            values = []
+            for osm_id in sorted(batch.keys(), key=int):
+                new_data = batch[osm_id]
+                values.append((
+                    osm_id,
+                    new_data['changeset_id'],
+                    new_data['changeset_version'],
+                    new_data['changeset_timestamp'],
+                    new_data['changeset_user']))
+            query = \
+                'UPDATE %s."%s" AS osm SET changeset_id=data.changeset_id, ' \
+                'changeset_version=data.changeset_version, ' \
+                'changeset_timestamp=data.changeset_timestamp, ' \
+                'changeset_user=data.changeset_user ' \
+                'FROM (VALUES %%s) AS data(osm_id, changeset_id, changeset_version, ' \
+                'changeset_timestamp, changeset_user) ' \
+                'WHERE osm."%s"=data.osm_id' % (
+                    self.default['DBSCHEMA_PRODUCTION'], table_name, osm_id_column)
             try:
-                value = value.replace('\'', '\'\'')
-            except (TypeError, AttributeError):
-                pass
-            sets.append('%s=\'%s\'' % (field, value))
-        connection = self.create_connection()
-        cursor = connection.cursor()
-        try:
-            query = 'UPDATE %s.%s SET %s WHERE %s=%s' % (self.default['DBSCHEMA_PRODUCTION'],
-                                                         table_name, ','.join(sets), osm_id_column, osm_id)
-            cursor.execute(query)
-            connection.commit()
-        except ProgrammingError as e:
-            connection.rollback()
-            self.info('%s' % e)
-        connection.close()
+                # The transaction is rolled back by borrow_connection on error.
+                with self.borrow_connection() as connection:
+                    cursor = connection.cursor()
+                    execute_values(
+                        cursor, query, values,
+                        template='(%s::bigint, %s::numeric, %s::numeric, %s::timestamptz, %s::varchar)',
+                        page_size=len(values))
+                    connection.commit()
+                    self.metrics.inc('docker_osm_db_round_trips_total', 2)
+                    self.info('Update %s rows of %s' % (len(values), table_name))
+            except (OperationalError, InterfaceError) as e:
+                # The database is unreachable, the batch is written by the next flush.
+                self.info('Can not update %s rows of %s, retrying later : %s' % (len(values), table_name, e))
+                pending = self.enrich_batch.setdefault((table_name, osm_id_column), {})
+                for osm_id, new_data in batch.items():
+                    if osm_id not in pending or \
+                            pending[osm_id]['changeset_timestamp'] < new_data['changeset_timestamp']:
+                        pending[osm_id] = new_data
+            except Error as e:
+                self.info('Can not update %s rows of %s, osm ids %s dropped : %s' % (
+                    len(values), table_name, ', '.join(str(value[0]) for value in values), e))
 
     # THIS PROCESS BELOW IS FOR EMPTY CHANGESET
-    def update_osm_enrich_from_api_in_batch(
-            self, osm_ids, osm_type, row_batch, table_name, osm_id_column):
+    def wait_api_rate_limit(self):
+        """Wait until the next request to the OSM API is allowed by API_RATE_LIMIT."""
+        rate_limit = float(self.default['API_RATE_LIMIT'])
+        if rate_limit <= 0:
+            return
+        with self.api_lock:
+            now = monotonic()
+            wait = self.api_next_request - now
+            self.api_next_request = max(now, self.api_next_request) + 1.0 / rate_limit
+        if wait > 0:
+            sleep(wait)
+
+    def get_api_connection(self, scheme, netloc, reset=False):
+        """ Return the keep-alive connection to the OSM API of this thread
+
+        :param scheme: Scheme of OSM API URL, http or https
+        :type scheme: str
+
+        :param netloc: Host and port of OSM API URL
+        :type netloc: str
+
+        :param reset: Close the current connection and open a new one
+        :type reset: bool
+        """
+        connection = getattr(self.api_connection, 'connection', None)
+        if connection and (reset or connection.host_netloc != netloc):
+            connection.close()
+            connection = None
+        if not connection:
+            if scheme == 'https':
+                connection = HTTPSConnection(netloc, timeout=60)
+            else:
+                connection = HTTPConnection(netloc, timeout=60)
+            connection.host_netloc = netloc
+            self.api_connection.connection = connection
+        return connection
+
+    def request_osm_api(self, url):
+        """ Get content of url from OSM API.
+        Retry with exponential backoff when the request fails or is throttled.
+
+        :param url: Url of the OSM API
+        :type url: str
+
+        :return: Content of the response, None if it is failed
+        :rtype: bytes
+        """
+        url = urlsplit(url)
+        path = url.path
+        if url.query:
+            path += '?%s' % url.query
+        max_retry = int(self.default['API_MAX_RETRY'])
+        for attempt in range(max_retry + 1):
+            if attempt > 0:
+                sleep(2 ** attempt)
+            self.wait_api_rate_limit()
+            try:
+                connection = self.get_api_connection(url.scheme, url.netloc, reset=attempt > 0)
+                self.metrics.inc('docker_osm_api_calls_total')
+                connection.request('GET', path)
+                response = connection.getresponse()
+                content = response.read()
+            except (HTTPException, OSError) as e:
+                self.info('Request %s failed : %s' % (url.geturl(), e))
+                self.metrics.inc('docker_osm_api_errors_total')
+                continue
+            if response.status == 200:
+                return content
+            self.metrics.inc('docker_osm_api_errors_total')
+            self.info('Request %s returns %s' % (url.geturl(), response.status))
+            if response.status not in (429, 500, 502, 503, 504):
+                return None
+        return None
+
+    def get_osm_data_from_api(self, osm_ids, osm_type):
         """ Get osm data from OSM API in Batch
 
         :param osm_ids: osm id in list
@@ -383,8 +809,32 @@ class Enrich(object):
         :param osm_type: feature type of this osm
         :type osm_type: str
 
-        :param osm_type: feature type of this osm
-        :type osm_type: str
+        :return: List of osm data in xmltodict format
+        :rtype: list
+        """
+        osm_type_on_url = osm_type + 's'
+        url = join(self.default['OSM_API_URL'], osm_type_on_url)
+        url += '?%s=%s' % (osm_type_on_url, ','.join(osm_ids))
+        self.info(url)
+        raw_content = self.request_osm_api(url)
+        if not raw_content:
+            return []
+        try:
+            raw_content = xmltodict.parse(raw_content)
+            osm_data_list = raw_content['osm'][osm_type]
+        except Exception as e:
+            self.info('%s' % e)
+            return []
+        if type(osm_data_list) != list:
+            osm_data_list = [osm_data_list]
+        return osm_data_list
+
+    def update_osm_enrich_from_api_in_batch(
+            self, osm_data_list, row_batch, table_name, osm_id_column):
+        """ Update osm data that got from OSM API in Batch
+
+        :param osm_data_list: osm data in xmltodict format
+        :type osm_data_list: list
 
         :param row_batch: Row data from local database in dictionary
         :type row_batch: Dict
@@ -395,46 +845,91 @@ class Enrich(object):
         :param osm_id_column: Column name of osm_id
         :type osm_id_column: str
         """
-        if len(osm_ids) == 0:
-            return
-        osm_type_on_url = osm_type + 's'
-        url = join(self.default['OSM_API_URL'], osm_type_on_url)
-        url += '?%s=%s' % (osm_type_on_url, ','.join(osm_ids))
-        self.info(url)
-        content = None
-        try:
-            raw_content = request.urlopen(url).read()
-            raw_content = xmltodict.parse(raw_content)
-            if type(raw_content['osm'][osm_type]) == list:
-                for osm in raw_content['osm'][osm_type]:
-                    osm_id = self.check_data_on_dict(osm, '@id')
-                    row = self.check_data_on_dict(row_batch, osm_id)
-                    new_data = self.get_osm_enrich_new_data(
-                        osm, row)
-                    self.update_enrich_into_database(
-                        table_name, osm_id_column, osm_id, new_data)
-
-            else:
-                osm_id = self.check_data_on_dict(
-                    raw_content['osm'][osm_type], '@id')
+        for osm in osm_data_list:
+            try:
+                osm_id = self.check_data_on_dict(osm, '@id')
                 row = self.check_data_on_dict(row_batch, osm_id)
                 new_data = self.get_osm_enrich_new_data(
-                    raw_content['osm'][osm_type], row)
+                    osm, row)
                 self.update_enrich_into_database(
                     table_name, osm_id_column, osm_id, new_data)
+            except Exception as e:
+                self.info('%s' % e)
 
-        except Exception as e:
-            self.info('%s' % e)
-        return content
+    def apply_osm_enrich_from_api_request(self, api_request, table_name, osm_id_column, advance=True):
+        """ Wait for an OSM API request, update its data and advance
+        the checkpoint of table when its updates are written.
 
-    def process_empty_changeset_from_table(self, table_name, table_columns, osm_id_column, osm_type):
-        """ Processing all data from table
+        :param api_request: Future of the request and the row batch
+        :type api_request: tuple
 
-        :param table_name: Table source
+        :param table_name: Table source of rows
         :type table_name: str
 
-        :param table_columns: columns of tables
-        :type table_columns: list
+        :param osm_id_column: Column name of osm_id
+        :type osm_id_column: str
+
+        :param advance: False once a previous request of the scan failed
+        :type advance: bool
+
+        :return: Whether the checkpoint can still advance
+        :rtype: bool
+        """
+        future, row_batch = api_request
+        osm_data_list = future.result()
+        if not osm_data_list:
+            # The rows of the failed request are retried from the checkpoint.
+            self.info('No data from the OSM API for %s rows of %s' % (len(row_batch), table_name))
+            return False
+        self.update_osm_enrich_from_api_in_batch(
+            osm_data_list, row_batch, table_name, osm_id_column)
+        if advance and (table_name, osm_id_column) not in self.enrich_batch:
+            self.update_empty_changeset_checkpoint(
+                table_name, max(int(osm_id) for osm_id in row_batch.keys()))
+        return advance
+
+    def get_empty_changeset_checkpoint_path(self, table_name):
+        return join(self.cache_folder, 'empty_changeset_%s' % table_name)
+
+    def get_empty_changeset_checkpoint(self, table_name):
+        """ Return the last osm id of table that has been enriched from API
+        return None if the scan of the table is not started
+        """
+        if not self.cache_folder:
+            return None
+        try:
+            with open(self.get_empty_changeset_checkpoint_path(table_name), 'r') as f:
+                return int(f.read())
+        except (IOError, ValueError):
+            return None
+
+    def update_empty_changeset_checkpoint(self, table_name, osm_id):
+        """ Save the last osm id of table that has been enriched from API,
+        remove it when osm_id is None
+        """
+        if not self.cache_folder or not exists(self.cache_folder):
+            return
+        checkpoint_file = self.get_empty_changeset_checkpoint_path(table_name)
+        try:
+            if osm_id is None:
+                if exists(checkpoint_file):
+                    remove(checkpoint_file)
+            else:
+                with open(checkpoint_file + '.tmp', 'w') as f:
+                    f.write('%s' % osm_id)
+                replace(checkpoint_file + '.tmp', checkpoint_file)
+        except (IOError, OSError):
+            self.info('checkpoint file of %s can\'t be updated' % table_name)
+
+    def process_empty_changeset_from_table(self, table_name, osm_id_column, osm_type):
+        """ Processing all data from table.
+        The rows are read by chunks of ENRICH_BATCH_SIZE after the last osm id
+        read, each chunk in its own short transaction, so the scan does not
+        hold back the vacuum while it waits for the API. The scan resumes from
+        the last enriched osm id after a restart.
+
+        :param table_name: Table source
+        :type table_name: str
 
         :param osm_type: feature type of this osm
         :type osm_type: str
@@ -445,35 +940,73 @@ class Enrich(object):
         :param osm_id_column: Column name of osm_id
         :type osm_id_column: str
         """
-        # noinspection PyUnboundLocalVariable
-        connection = self.create_connection()
-        cursor = connection.cursor()
+        chunk_size = int(self.default['ENRICH_BATCH_SIZE'])
         row_batch = {}
         osm_ids = []
+        api_batch_size = int(self.default['API_BATCH_SIZE'])
+        api_workers = int(self.default['API_WORKERS'])
+        api_requests = deque()
+        advance = True
+        executor = ThreadPoolExecutor(max_workers=api_workers)
         try:
-            check_sql = ''' select * from %s."%s" WHERE "changeset_timestamp" 
-            IS NULL AND "osm_id" IS NOT NULL ORDER BY "osm_id" ''' % (self.default['DBSCHEMA_PRODUCTION'], table_name)
-            cursor.execute(check_sql)
-            row = True
-            while row:
-                # do something with row
-                row = cursor.fetchone()
-                if row:
-                    row = dict(zip(table_columns, row))
+            check_sql = ''' select "%s", "changeset_timestamp" from %s."%s" WHERE "changeset_timestamp" 
+            IS NULL AND "%s" IS NOT NULL ''' % (
+                osm_id_column, self.default['DBSCHEMA_PRODUCTION'], table_name, osm_id_column)
+            last_osm_id = self.get_empty_changeset_checkpoint(table_name)
+            if last_osm_id is not None:
+                self.info('Resume %s from osm id %s' % (table_name, last_osm_id))
+            while True:
+                rows = self.get_empty_changeset_rows(check_sql, osm_id_column, last_osm_id, chunk_size)
+                for row in rows:
+                    row = dict(zip((osm_id_column, 'changeset_timestamp'), row))
                     row_batch['%s' % row[osm_id_column]] = row
                     osm_ids.append('%s' % row[osm_id_column])
-                    if len(osm_ids) == 30:
-                        self.update_osm_enrich_from_api_in_batch(
-                            osm_ids, osm_type, row_batch, table_name, osm_id_column)
+                    if len(osm_ids) == api_batch_size:
+                        api_requests.append((
+                            executor.submit(self.get_osm_data_from_api, osm_ids, osm_type),
+                            row_batch))
                         row_batch = {}
                         osm_ids = []
 
-            self.update_osm_enrich_from_api_in_batch(
-                osm_ids, osm_type, row_batch, table_name, osm_id_column)
+                    # keep a bounded number of requests in flight
+                    while len(api_requests) >= api_workers * 2:
+                        advance = self.apply_osm_enrich_from_api_request(
+                            api_requests.popleft(), table_name, osm_id_column, advance)
+                if len(rows) < chunk_size:
+                    break
+                last_osm_id = rows[-1][0]
+
+            if osm_ids:
+                api_requests.append((
+                    executor.submit(self.get_osm_data_from_api, osm_ids, osm_type),
+                    row_batch))
+            while api_requests:
+                advance = self.apply_osm_enrich_from_api_request(
+                    api_requests.popleft(), table_name, osm_id_column, advance)
+            self.flush_enrich_into_database(table_name, osm_id_column)
+            self.update_empty_changeset_checkpoint(table_name, None)
 
         except ProgrammingError as e:
-            connection.rollback()
             self.info('%s' % e)
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    def get_empty_changeset_rows(self, check_sql, osm_id_column, last_osm_id, chunk_size):
+        """ Return the next chunk of rows without changeset after the osm id.
+        The transaction ends with the chunk.
+        """
+        parameters = None
+        if last_osm_id is not None:
+            check_sql += ' AND "%s" > %%s ' % osm_id_column
+            parameters = (last_osm_id,)
+        check_sql += ' ORDER BY "%s" LIMIT %s ' % (osm_id_column, chunk_size)
+        with self.borrow_connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(check_sql, parameters)
+            rows = cursor.fetchall()
+            connection.commit()
+        self.metrics.inc('docker_osm_db_round_trips_total')
+        return rows
 
     def enrich_empty_changeset(self):
         """Enrich database that has empty changeset by using OSM API URL
@@ -482,122 +1015,336 @@ class Enrich(object):
         for table, table_data in self.mapping_database_schema.items():
             osm_id_columnn = table_data['osm_id_columnn']
             osm_type = table_data['osm_type']
-            columns = table_data['columns']
             if osm_id_columnn is not None:
                 self.info('Checking data from table %s' % table)
                 self.process_empty_changeset_from_table(
-                    table, columns, osm_id_columnn, osm_type)
+                    table, osm_id_columnn, osm_type)
             else:
                 self.info('Does not know osm_id column for %s.' % table)
 
     # THIS PROCESS BELOW IS FOR CHECKING DIFF FILES
-    def enrich_database_from_osm_data(self, osm_data, osm_data_type):
-        """ Convert data from xml of osm into json
-        and check if from osm is newer than from database
+    def enrich_database_from_osm_data(self, osm_data_by_id, osm_data_type):
+        """ Check a batch of osm data against the tables their tags can be in
+        and update the rows that are older than the osm data.
+        Every table is looked up once for the whole batch.
 
-        :param from_osm: Data that got from osm
-        :type from_osm: dict
+        :param osm_data_by_id: Data that got from osm, keyed by osm id
+        :type osm_data_by_id: dict
 
-        :param from_database: Data that in local database
-        :type from_database: dict
+        :param osm_data_type: feature type of this osm
+        :type osm_data_type: str
+        """
+        osm_ids = []
+        osm_ids_by_table = {}
+        for osm_id, osm_data in osm_data_by_id.items():
+            if self.is_non_recognized_id(osm_data_type, osm_id):
+                continue
+            tables = self.get_tables_of_osm_data(osm_data_type, osm_data)
+            if not tables:
+                continue
+            osm_ids.append(osm_id)
+            for table in tables:
+                osm_ids_by_table.setdefault(table, []).append(osm_id)
+        if not osm_ids:
+            return
+        found_osm_ids = set()
+        for table in sorted(osm_ids_by_table.keys()):
+            table_data = self.mapping_database_schema[table]
+            table_osm_ids = osm_ids_by_table[table]
+            with self.borrow_connection() as connection:
+                cursor = connection.cursor()
+                try:
+                    validate_sql = \
+                        'select "%s", "changeset_timestamp" from %s."%s" WHERE "%s" = ANY(%%s)' % (
+                            table_data['osm_id_columnn'], self.default['DBSCHEMA_PRODUCTION'],
+                            table, table_data['osm_id_columnn'])
+                    cursor.execute(validate_sql, ([int(osm_id) for osm_id in table_osm_ids],))
+                    self.metrics.inc('docker_osm_db_round_trips_total')
+                    rows = cursor.fetchall()
+                except Exception as e:
+                    connection.rollback()
+                    self.info('error when processing %s: %s' % (table, e))
+                    continue
+            for osm_id, changeset_timestamp in rows:
+                osm_id = '%s' % osm_id
+                found_osm_ids.add(osm_id)
+                new_data = self.get_osm_enrich_new_data(
+                    osm_data_by_id[osm_id], {'changeset_timestamp': changeset_timestamp})
+                self.update_enrich_into_database(
+                    table, table_data['osm_id_columnn'], osm_id, new_data)
 
-        :return: Dictionary of new data that need to be inserted
+        # if this id is not found in any table add in cache
+        for osm_id in osm_ids:
+            if osm_id not in found_osm_ids:
+                self.get_or_create_non_recognized_id(osm_data_type, osm_id)
+
+    @classmethod
+    def iterate_modified_osm_data(cls, gzip_file):
+        """ Yield modified osm data of an osmChange file one by one.
+        The file is streamed from the gzip, so the memory stays constant
+        whatever the size of the diff file.
+
+        :param gzip_file: Path of the osmChange gzip file
+        :type gzip_file: str
+
+        :return: Generator of osm data type and osm data in xmltodict format
+        :rtype: generator
+        """
+        with gzip.open(gzip_file, 'rb') as f:
+            action = None
+            for event, element in iterparse(f, events=('start', 'end')):
+                if event == 'start':
+                    if element.tag in ('modify', 'create', 'delete'):
+                        action = element
+                    continue
+
+                if element.tag in cls.osm_data_types and action is not None:
+                    if action.tag == 'modify':
+                        osm_data = dict(
+                            ('@%s' % key, value) for key, value in element.attrib.items())
+                        osm_data['tag'] = [
+                            {'@k': tag.get('k'), '@v': tag.get('v')} for tag in element.iter('tag')]
+                        yield element.tag, osm_data
+                    # drop the processed element so the tree never grows
+                    action.clear()
+                elif element.tag in ('modify', 'create', 'delete'):
+                    element.clear()
+                    action = None
+
+    @classmethod
+    def summarize_diff_file(cls, gzip_file):
+        """ Return the newest version of every modified osm data of a diff file.
+        This runs in the worker processes, so it must not use the instance.
+
+        :param gzip_file: Path of the osmChange gzip file
+        :type gzip_file: str
+
+        :return: Dictionary of osm data type, osm id and
+            (version, changeset, timestamp, user, tags) of the osm data
         :rtype: dict
         """
-        osm_id = self.check_data_on_dict(
-            osm_data, '@id')
-        for table, table_data in self.mapping_database_schema.items():
-            if osm_data_type == table_data['osm_type']:
+        summary = {}
+        for osm_data_type, osm_data in cls.iterate_modified_osm_data(gzip_file):
+            osm_data_by_id = summary.setdefault(osm_data_type, {})
+            osm_id = osm_data.get('@id')
+            version = int(osm_data.get('@version', 0))
+            current_osm_data = osm_data_by_id.get(osm_id)
+            if not current_osm_data or current_osm_data[0] < version:
+                osm_data_by_id[osm_id] = (
+                    version,
+                    osm_data.get('@changeset'),
+                    osm_data.get('@timestamp'),
+                    osm_data.get('@user'),
+                    tuple((tag['@k'], tag['@v']) for tag in osm_data['tag']))
+        return summary
 
-                # check if this osm is not found on database
-                if self.is_non_recognized_id(osm_data_type, osm_id):
-                    continue
+    @staticmethod
+    def merge_diff_file_summary(summary, other_summary):
+        """ Merge other_summary into summary, keeping the newest version
+        of every osm data.
+        """
+        for osm_data_type, other_osm_data_by_id in other_summary.items():
+            osm_data_by_id = summary.setdefault(osm_data_type, {})
+            for osm_id, osm_data in other_osm_data_by_id.items():
+                current_osm_data = osm_data_by_id.get(osm_id)
+                if not current_osm_data or current_osm_data[0] < osm_data[0]:
+                    osm_data_by_id[osm_id] = osm_data
 
-                connection = self.create_connection()
-                cursor = connection.cursor()
-                try:
-                    validate_sql = ''' select * from %s."%s" WHERE "%s"=%s  ''' % (self.default['DBSCHEMA_PRODUCTION'],
-                                                                                   table, table_data['osm_id_columnn'],
-                                                                                   osm_id)
-                    cursor.execute(validate_sql)
-                    row = cursor.fetchone()
-                    if row:
-                        row = dict(zip(table_data['columns'], row))
-                        new_data = self.get_osm_enrich_new_data(osm_data, row)
-                        self.update_enrich_into_database(
-                            table, table_data['osm_id_columnn'], osm_id, new_data)
-                    else:
-                        # if this id is not found add in cache
-                        self.get_or_create_non_recognized_id(osm_data_type, osm_id)
-                except Exception as e:
-                    self.info('error when processing %s: %s' % (osm_id, e))
-                connection.close()
+    @staticmethod
+    def iterate_diff_file_summary(summary):
+        """ Yield osm data of a diff file summary in xmltodict format
+        """
+        for osm_data_type, osm_data_by_id in summary.items():
+            for osm_id, (version, changeset, timestamp, user, tags) in osm_data_by_id.items():
+                yield osm_data_type, {
+                    '@id': osm_id,
+                    '@version': version,
+                    '@changeset': changeset,
+                    '@timestamp': timestamp,
+                    '@user': user,
+                    'tag': [{'@k': key, '@v': value} for key, value in tags]
+                }
+
+    def enrich_database_from_osm_data_iterable(self, osm_data_iterable):
+        """ Enrich database from osm data, by batch of ENRICH_BATCH_SIZE
+        osm ids per osm type, and write the updates.
+
+        :param osm_data_iterable: Iterable of osm data type and osm data
+        :type osm_data_iterable: iterable
+        """
+        start = monotonic()
+        elements = 0
+        osm_data_batch = {}
+        for osm_data_type, osm_data in osm_data_iterable:
+            elements += 1
+            osm_data_by_id = osm_data_batch.setdefault(osm_data_type, {})
+            osm_id = self.check_data_on_dict(osm_data, '@id')
+            current_osm_data = self.check_data_on_dict(osm_data_by_id, osm_id)
+            if not current_osm_data or \
+                    int(current_osm_data['@version']) < int(osm_data['@version']):
+                osm_data_by_id[osm_id] = osm_data
+            if len(osm_data_by_id) >= int(self.default['ENRICH_BATCH_SIZE']):
+                self.enrich_database_from_osm_data(
+                    osm_data_by_id, osm_data_type
+                )
+                osm_data_batch[osm_data_type] = {}
+        for osm_data_type, osm_data_by_id in osm_data_batch.items():
+            self.enrich_database_from_osm_data(
+                osm_data_by_id, osm_data_type
+            )
+        self.flush_enrich_into_database()
+        self.flush_non_recognized_ids()
+        self.metrics.inc('docker_osm_enrich_elements_total', elements)
+        self.metrics.set('docker_osm_enrich_elements_per_second', elements / max(monotonic() - start, 0.001))
+
+    def open_manifest(self):
+        """ Open the manifest of the diffs shared with the downloader and importer.
+        return None if the importer does not maintain it yet
+        """
+        if self.manifest is None:
+            manifest_file = join(self.default['SETTINGS'], 'manifest.sqlite')
+            if not exists(manifest_file):
+                return None
+            manifest = sqlite3.connect(manifest_file, timeout=60)
+            manifest.executescript(MANIFEST_SCHEMA)
+            if not manifest.execute(
+                    "SELECT value FROM manifest_meta WHERE key = 'backfilled'").fetchone():
+                manifest.close()
+                return None
+            self.manifest = manifest
+        return self.manifest
+
+    def get_diff_files_to_enrich(self):
+        """ Return the imported diff files that are not enriched yet, in order.
+        The diff files older than the cache are marked as enriched.
+        """
+        manifest = self.open_manifest()
+        target_folder = self.default['IMPORT_DONE']
+        if not manifest:
+            return [
+                filename for filename in sorted(listdir(target_folder))
+                if filename.endswith('.gz') and (
+                        not self.latest_diff_file or self.latest_diff_file < filename)]
+
+        if self.latest_diff_file:
+            with manifest:
+                manifest.execute(
+                    'UPDATE diffs SET enriched_at = ? WHERE enriched_at IS NULL AND name <= ?',
+                    (datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'), self.latest_diff_file))
+        filenames = []
+        for filename, in manifest.execute(
+                'SELECT name FROM diffs WHERE enriched_at IS NULL AND imported_at IS NOT NULL '
+                'ORDER BY sequence'):
+            if exists(join(target_folder, filename)):
+                filenames.append(filename)
+            else:
+                self.info('%s is archived, skip it' % filename)
+        return filenames
+
+    def mark_diff_files_enriched(self, filenames):
+        """ Mark the diff files as enriched in the manifest
+        """
+        self.metrics.inc('docker_osm_diffs_enriched_total', len(filenames))
+        manifest = self.open_manifest()
+        if not manifest:
+            return
+        with manifest:
+            manifest.executemany(
+                'UPDATE diffs SET enriched_at = ? WHERE name = ?',
+                [(datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'), filename) for filename in filenames])
+
+    def update_latest_diff_file(self, filename):
+        """ Save filename as the latest diff file that is enriched
+        """
+        self.latest_diff_file = filename
+        try:
+            cache_file = self.get_cache_path()
+            f = open(cache_file + '.tmp', 'w')
+            f.write(filename)
+            f.close()
+            replace(cache_file + '.tmp', cache_file)
+        except IOError:
+            self.info('cache file can\'t be created')
 
     def enrich_database_from_diff_file(self):
+        """ Enrich database from the diff files that are newer than the cache.
+
+        With DIFF_WORKERS > 1, a window of diff files is decompressed and parsed
+        in parallel processes. Their summaries are merged so only the newest
+        changeset of every osm data is written once the window is committed.
+
+        Only the diff files that are written successfully are marked as enriched,
+        and the cache stops before the first failed file so it is retried.
+        """
         # check latest diff file
         if self.get_cache_file():
             self.latest_diff_file = open(self.get_cache_file(), "r").read()
 
         # get list diff file
-        next_latest_diff_file = None
         target_folder = self.default['IMPORT_DONE']
         self.info('Enrich Database with diff file in %s' % self.default['IMPORT_DONE'])
         if not exists(target_folder):
             self.info('Folder %s is not ready yet' % target_folder)
             return
-        for filename in sorted(listdir(target_folder)):
-            try:
-                if filename.endswith('.gz'):
-                    if not self.latest_diff_file or self.latest_diff_file < filename:
-                        self.info('Processing %s' % filename)
-                        # if it is newest file
-                        # process for getting this
-                        gzip_file = join(target_folder, filename)
-                        if getsize(gzip_file) > self.default['MAX_DIFF_FILE_SIZE']:
-                            self.info('File is too big, skip it')
-                            continue
-                        f = gzip.open(gzip_file, 'rb')
-                        file_content = f.read()
-                        f.close()
-                        raw_content = xmltodict.parse(file_content)
-                        try:
-                            modify_list = raw_content['osmChange']['modify']
-                            for list in modify_list:
-                                for key, value in list.items():
-                                    if type(value) != dict:
-                                        for osm_data in value:
-                                            self.enrich_database_from_osm_data(
-                                                osm_data, key
-                                            )
-                                    else:
-                                        self.enrich_database_from_osm_data(
-                                            value, key
-                                        )
-                        except KeyError:
-                            self.info('%s can not be opened' % filename)
-                        if not next_latest_diff_file or next_latest_diff_file < filename:
-                            next_latest_diff_file = filename
-            except Exception as e:
-                self.info('Error when processing %s : %s' % (filename, e))
+        filenames = self.get_diff_files_to_enrich()
 
-            if next_latest_diff_file:
+        diff_workers = int(self.default['DIFF_WORKERS'])
+        failed = False
+        if diff_workers <= 1:
+            for filename in filenames:
+                self.info('Processing %s' % filename)
                 try:
-                    cache_file = self.get_cache_path()
-                    f = open(cache_file, 'w')
-                    f.write(next_latest_diff_file)
-                    f.close()
-                except IOError:
-                    self.info('cache file can\'t be created')
+                    self.enrich_database_from_osm_data_iterable(
+                        self.iterate_modified_osm_data(join(target_folder, filename)))
+                except Exception as e:
+                    self.info('Error when processing %s : %s' % (filename, e))
+                    failed = True
+                    continue
+                if not failed:
+                    self.update_latest_diff_file(filename)
+                self.mark_diff_files_enriched([filename])
+            return
+
+        with ProcessPoolExecutor(max_workers=diff_workers) as executor:
+            for index in range(0, len(filenames), diff_workers):
+                window = filenames[index:index + diff_workers]
+                futures = [
+                    executor.submit(self.summarize_diff_file, join(target_folder, filename))
+                    for filename in window]
+                summary = {}
+                enriched = []
+                latest_diff_file = None
+                for filename, future in zip(window, futures):
+                    self.info('Processing %s' % filename)
+                    try:
+                        self.merge_diff_file_summary(summary, future.result())
+                    except Exception as e:
+                        self.info('Error when processing %s : %s' % (filename, e))
+                        failed = True
+                        continue
+                    if not failed:
+                        latest_diff_file = filename
+                    enriched.append(filename)
+                try:
+                    self.enrich_database_from_osm_data_iterable(
+                        self.iterate_diff_file_summary(summary))
+                except Exception as e:
+                    self.info('Error when processing %s : %s' % (', '.join(window), e))
+                    return
+                if latest_diff_file:
+                    self.update_latest_diff_file(latest_diff_file)
+                self.mark_diff_files_enriched(enriched)
 
     def locate_table(self, name, schema):
         """Check for tables in the DB table exists in the DB"""
-        connection = self.create_connection()
-        cursor = connection.cursor()
         sql = """ SELECT EXISTS (SELECT 1 AS result from information_schema.tables 
               where table_name like  TEMP_TABLE and table_schema = 'TEMP_SCHEMA'); """
-        cursor.execute(sql.replace('TEMP_TABLE', '%s' % name).replace('TEMP_SCHEMA', '%s' % schema))
-        # noinspection PyUnboundLocalVariable
-        return cursor.fetchone()[0]
+        with self.borrow_connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(sql.replace('TEMP_TABLE', '%s' % name).replace('TEMP_SCHEMA', '%s' % schema))
+            self.metrics.inc('docker_osm_db_round_trips_total')
+            # noinspection PyUnboundLocalVariable
+            return cursor.fetchone()[0]
 
     def run(self):
         """First checker."""
@@ -619,4 +1366,5 @@ class Enrich(object):
 
 if __name__ == '__main__':
     enrich = Enrich()
+    enrich.start_metrics()
     enrich.run()
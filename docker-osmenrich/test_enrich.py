@@ -0,0 +1,149 @@
+from array import array
+from os.path import exists
+
+import pytest
+
+from enrich import Enrich, OsmIdIndex
+
+MAPPING = """
+tables:
+  buildings:
+    type: polygon
+    columns:
+    - name: osm_id
+      type: id
+    - name: geometry
+      type: geometry
+    mapping:
+      building: [__any__]
+    filters:
+      reject:
+        building: [no]
+  roads:
+    type: linestring
+    columns:
+    - name: osm_id
+      type: id
+    - name: type
+      type: mapping_value
+    mappings:
+      roads:
+        mapping:
+          highway: [primary, residential]
+      railway:
+        mapping:
+          railway: [rail]
+    filters:
+      require:
+        name: [__any__]
+  amenities:
+    type: point
+    columns:
+    - name: osm_id
+      type: id
+    mapping:
+      amenity: [school, yes]
+  all_points:
+    type: point
+    columns:
+    - name: osm_id
+      type: id
+    mapping:
+      __any__: [__any__]
+"""
+
+
+@pytest.fixture
+def enrich(tmpdir, monkeypatch):
+    tmpdir.join('mapping.yml').write(MAPPING)
+    monkeypatch.setenv('SETTINGS', str(tmpdir))
+    monkeypatch.setenv('CACHE', str(tmpdir.join('cache')))
+    return Enrich()
+
+
+def osm_data(**tags):
+    return {'tag': [{'@k': key, '@v': value} for key, value in tags.items()]}
+
+
+def test_tables_of_osm_data(enrich):
+    assert enrich.get_tables_of_osm_data('way', osm_data(building='house')) == {'osm_buildings'}
+    assert enrich.get_tables_of_osm_data('way', osm_data(highway='primary', name='A1')) == {'osm_roads'}
+    assert enrich.get_tables_of_osm_data('way', osm_data(railway='rail', name='A')) == {'osm_roads'}
+    assert enrich.get_tables_of_osm_data('way', osm_data(highway='footway', name='A')) == set()
+    assert enrich.get_tables_of_osm_data('relation', osm_data(building='yes')) == set()
+
+
+def test_tables_of_osm_data_single_tag(enrich):
+    assert enrich.get_tables_of_osm_data('way', {'tag': {'@k': 'building', '@v': 'yes'}}) == {'osm_buildings'}
+
+
+def test_tables_of_osm_data_without_tags(enrich):
+    assert enrich.get_tables_of_osm_data('way', {}) == {'osm_buildings', 'osm_roads'}
+
+
+def test_tables_of_osm_data_any_table(enrich):
+    assert enrich.get_tables_of_osm_data('node', osm_data(shop='bakery')) == {'osm_all_points'}
+    assert enrich.get_tables_of_osm_data('node', osm_data(amenity='school')) == {
+        'osm_amenities', 'osm_all_points'}
+
+
+def test_mapping_values_are_literal(enrich):
+    # yes and no are strings in the mapping of imposm, not booleans.
+    assert enrich.get_tables_of_osm_data('node', osm_data(amenity='yes')) == {'osm_amenities', 'osm_all_points'}
+    assert enrich.get_tables_of_osm_data('node', osm_data(amenity='True')) == {'osm_all_points'}
+    assert enrich.get_tables_of_osm_data('way', osm_data(building='no')) == set()
+
+
+def test_table_filters(enrich):
+    assert enrich.match_table_filters('osm_roads', {'highway': 'primary', 'name': 'A1'})
+    assert not enrich.match_table_filters('osm_roads', {'highway': 'primary'})
+    assert enrich.match_table_filters('osm_buildings', {'building': 'yes'})
+    assert not enrich.match_table_filters('osm_buildings', {'building': 'no'})
+    assert enrich.match_table_filters('osm_unknown', {})
+
+
+def test_osm_id_index(tmpdir):
+    path = str(tmpdir.join('out_of_scope_osm_ids'))
+    index = OsmIdIndex(path)
+    for osm_id in (5, 3, 5, 1):
+        index.add(osm_id)
+    assert 5 in index and 3 in index and 1 in index
+    assert 2 not in index
+    assert len(index) == 3
+
+    index.flush()
+    assert not exists(path)
+    reloaded = OsmIdIndex(path)
+    assert sorted(reloaded.logged_ids) == [1, 3, 5]
+
+    reloaded.merge()
+    assert not exists(reloaded.log_path)
+    assert list(OsmIdIndex(path).ids) == [1, 3, 5]
+
+
+def test_osm_id_index_merges_large_log(tmpdir, monkeypatch):
+    monkeypatch.setattr(OsmIdIndex, 'merge_min_ids', 2)
+    path = str(tmpdir.join('out_of_scope_osm_ids'))
+    index = OsmIdIndex(path)
+    index.add(10)
+    index.add(-4)
+    index.flush()
+    assert exists(index.log_path)
+    index.add(7)
+    index.flush()
+    assert not exists(index.log_path)
+    assert list(index.ids) == [-4, 7, 10]
+    assert list(OsmIdIndex(path).ids) == [-4, 7, 10]
+
+
+def test_osm_id_index_recovers_log(tmpdir):
+    path = str(tmpdir.join('out_of_scope_osm_ids'))
+    with open(path, 'wb') as f:
+        array('q', [1, 2]).tofile(f)
+    with open(path + '.log', 'wb') as f:
+        # A merge stopped before removing the log, then a crash cut the last id.
+        f.write(array('q', [2, 8]).tobytes() + b'\x01\x02')
+    index = OsmIdIndex(path)
+    assert index.logged_ids == {8}
+    assert len(index) == 3
+    assert 8 in index and 2 in index
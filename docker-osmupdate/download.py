@@ -19,15 +19,39 @@
  ***************************************************************************/
 """
 
-from datetime import datetime
-from os import listdir, environ
-from os.path import exists, join, isabs, abspath
+import json
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from hashlib import sha256
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from os import listdir, environ, remove, rename, stat
+from os.path import exists, join, isabs, abspath, getsize
 from subprocess import call, Popen, PIPE
 from sys import exit, stderr
-from time import sleep
+from threading import local
+from time import sleep, monotonic
+from urllib.parse import urlsplit, unquote
+from zlib import decompress, decompressobj, MAX_WBITS, error as ZlibError
+
+from manifest import MANIFEST_SCHEMA
+from metrics import Metrics
+
+# Metrics of the downloader.
+METRICS = {
+    'docker_osm_diff_download_seconds': ('summary', 'Time spent to download a diff.'),
+    'docker_osm_diff_download_bytes_total': ('counter', 'Size of the downloaded diffs.'),
+    'docker_osm_diffs_downloaded_total': ('counter', 'Number of downloaded diffs.')
+}
 
 
 class Downloader(object):
+    # Seconds between two sequences of the replication.
+    replication_interval = {
+        'minute': 60,
+        'hour': 3600,
+        'day': 86400
+    }
 
     def __init__(self):
         # Default values which can be overwritten.
@@ -41,8 +65,15 @@ class Downloader(object):
             'IMPORT_DONE': 'import_done',
             'SETTINGS': 'settings',
             'TIME': 120,
+            'QUEUE_MAX_DEPTH': '10',
+            'REPLICATION_CLIENT': 'osmupdate',
+            'REPLICATION_WORKERS': '4',
+            'METRICS_PORT': '9898',
         }
         self.osm_file = None
+        self.manifest = None
+        self.replication_connection = local()
+        self.metrics = None
 
     @staticmethod
     def info(message):
@@ -77,6 +108,15 @@ class Downloader(object):
                 msg = 'The folder %s does not exist.' % self.default[folder]
                 self.error(msg)
 
+        if self.default['REPLICATION_CLIENT'] not in ['osmupdate', 'native']:
+            msg = 'REPLICATION_CLIENT not supported : %s' % self.default['REPLICATION_CLIENT']
+            self.error(msg)
+        if self.default['REPLICATION_CLIENT'] == 'native' and \
+                self.default['DIFF'] not in self.replication_interval:
+            msg = 'DIFF %s is not supported by the native replication client, ' \
+                  'it can be minute, hour or day.' % self.default['DIFF']
+            self.error(msg)
+
         # Test files
         for f in listdir(self.default['SETTINGS']):
 
@@ -87,10 +127,133 @@ class Downloader(object):
 
         self.info('The checkup is OK.')
 
+    def start_metrics(self):
+        """Serve the metrics of the downloader."""
+        self.metrics = Metrics('osmupdate', METRICS, self.default['SETTINGS'], self.default['IMPORT_QUEUE'])
+        self.metrics.start(self.default['METRICS_PORT'])
+
+    def open_manifest(self):
+        """Open the manifest of the diffs shared with the importer and enrich."""
+        if self.manifest is None:
+            self.manifest = sqlite3.connect(
+                join(self.default['SETTINGS'], 'manifest.sqlite'), timeout=60)
+            self.manifest.executescript(MANIFEST_SCHEMA)
+        return self.manifest
+
+    @staticmethod
+    def diff_checksum(file_path):
+        """Size and SHA-256 of a diff."""
+        checksum = sha256()
+        with open(file_path, 'rb') as diff_file:
+            for chunk in iter(lambda: diff_file.read(1048576), b''):
+                checksum.update(chunk)
+        return getsize(file_path), checksum.hexdigest()
+
+    def queue_diff(self, file_name, partial_file_path, meta=None):
+        """Move a complete diff in the queue, then add it in the manifest.
+
+        The diff is in the queue before it is in the manifest, so a crash
+        in between leaves a diff without row, added back by
+        reconcile_manifest, never a row without diff.
+
+        :param meta: Key and value of manifest_meta updated with the diff
+        :type meta: tuple
+        """
+        # The importer may move the diff as soon as it is in the queue.
+        size, checksum = self.diff_checksum(partial_file_path)
+        rename(partial_file_path, join(self.default['IMPORT_QUEUE'], file_name))
+        self.register_diff(file_name, size, checksum, meta)
+
+    def register_diff(self, file_name, size, checksum, meta=None):
+        """Add a downloaded diff in the manifest."""
+        from_timestamp, to_timestamp = file_name.split('.')[0].split('->-')
+        manifest = self.open_manifest()
+        with manifest:
+            # The importer may have added the diff already, when it imported it.
+            manifest.execute(
+                'INSERT INTO diffs (name, from_timestamp, to_timestamp, size, checksum, downloaded_at) '
+                'VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (name) DO UPDATE SET '
+                'size = excluded.size, checksum = excluded.checksum, downloaded_at = excluded.downloaded_at',
+                (file_name, from_timestamp, to_timestamp, size, checksum,
+                 datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')))
+            if meta:
+                manifest.execute('INSERT OR REPLACE INTO manifest_meta (key, value) VALUES (?, ?)', meta)
+        self.metrics.inc('docker_osm_diffs_downloaded_total')
+        self.metrics.inc('docker_osm_diff_download_bytes_total', size)
+
+    def reconcile_manifest(self):
+        """Match the manifest and the queue after a crash.
+
+        The partial diffs are removed, the diffs of the queue missing in the
+        manifest are added, the diffs moved to IMPORT_DONE by an importer
+        which stopped before updating the manifest are marked as imported,
+        and the rows of diffs which are neither queued nor imported are
+        removed, so their interval is downloaded again. The replication
+        sequence is then looked up again from the latest diff.
+        """
+        manifest = self.open_manifest()
+        queued = set()
+        for diff in listdir(self.default['IMPORT_QUEUE']):
+            if diff.startswith('.'):
+                self.info('Removing the partial diff %s' % diff)
+                remove(join(self.default['IMPORT_QUEUE'], diff))
+            else:
+                queued.add(diff)
+
+        changed = False
+        registered = set(name for name, in manifest.execute('SELECT name FROM diffs'))
+        for diff in sorted(queued - registered):
+            self.info('Adding the queued diff %s in the manifest' % diff)
+            size, checksum = self.diff_checksum(join(self.default['IMPORT_QUEUE'], diff))
+            self.register_diff(diff, size, checksum)
+            changed = True
+
+        with manifest:
+            for name, in manifest.execute('SELECT name FROM diffs WHERE imported_at IS NULL').fetchall():
+                if name in queued:
+                    continue
+                if exists(join(self.default['IMPORT_DONE'], name)):
+                    self.info('Marking %s as imported in the manifest, the diff is in %s' % (
+                        name, self.default['IMPORT_DONE']))
+                    manifest.execute(
+                        'UPDATE diffs SET imported_at = ? WHERE name = ?',
+                        (datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'), name))
+                else:
+                    self.info('Removing %s from the manifest, the diff is missing' % name)
+                    manifest.execute('DELETE FROM diffs WHERE name = ?', (name,))
+                    changed = True
+            if changed:
+                manifest.execute("DELETE FROM manifest_meta WHERE key LIKE 'replication_sequence_%'")
+
+    def _wait_for_queue(self):
+        """Wait while QUEUE_MAX_DEPTH diffs are waiting to be imported.
+
+        The depth is read from IMPORT_QUEUE, a diff imported by an importer
+        which stopped before updating the manifest is not waiting anymore.
+        """
+        while True:
+            # Partial diffs are hidden files, they are not counted.
+            depth = len([
+                diff for diff in listdir(self.default['IMPORT_QUEUE']) if not diff.startswith('.')])
+            if depth < int(self.default['QUEUE_MAX_DEPTH']):
+                return
+            self.info('%s diffs are waiting to be imported, sleeping for 2 seconds.' % depth)
+            sleep(2.0)
+
     def _check_latest_timestamp(self):
         """Fetch the latest timestamp."""
+        # Take the timestamp of the latest downloaded diff from the manifest.
+        latest_diff = self.open_manifest().execute(
+            'SELECT to_timestamp FROM diffs ORDER BY sequence DESC LIMIT 1').fetchone()
+        if latest_diff:
+            self.info('Timestamp from the latest downloaded diff : %s' % latest_diff[0])
+            return latest_diff[0]
+
         # Check if diff to be imported is empty. If not, take the latest diff.
-        diff_to_be_imported = sorted(listdir(self.default['IMPORT_QUEUE']))
+        # Partial diffs are hidden files, they are not taken.
+        diff_to_be_imported = sorted(
+            diff for diff in listdir(self.default['IMPORT_QUEUE'])
+            if not diff.startswith('.'))
         if len(diff_to_be_imported):
             file_name = diff_to_be_imported[-1].split('.')[0]
             timestamp = file_name.split('->-')[1]
@@ -105,13 +268,7 @@ class Downloader(object):
 
             else:
                 # Take the timestamp from original file.
-                command = ['osmconvert', self.osm_file, '--out-timestamp']
-                processus = Popen(
-                    command, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-                timestamp, err = processus.communicate()
-
-                # Remove new line
-                timestamp = timestamp.strip()
+                timestamp = self._pbf_timestamp()
 
                 self.info('Timestamp from the original state file : %s' % timestamp)
 
@@ -125,9 +282,278 @@ class Downloader(object):
 
         return timestamp
 
+    @staticmethod
+    def _read_varint(data, index):
+        """Read a protobuf varint, return the value and the next index."""
+        value = 0
+        shift = 0
+        while True:
+            byte = data[index]
+            index += 1
+            value |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                return value, index
+            shift += 7
+
+    def _read_protobuf(self, data):
+        """Read the fields of a protobuf message, as a dictionary of field number and values."""
+        fields = {}
+        index = 0
+        while index < len(data):
+            key, index = self._read_varint(data, index)
+            wire_type = key & 0x07
+            if wire_type == 0:
+                value, index = self._read_varint(data, index)
+            elif wire_type == 2:
+                length, index = self._read_varint(data, index)
+                value = data[index:index + length]
+                index += length
+            elif wire_type == 1:
+                value = data[index:index + 8]
+                index += 8
+            elif wire_type == 5:
+                value = data[index:index + 4]
+                index += 4
+            else:
+                raise ValueError('Unsupported protobuf wire type %s' % wire_type)
+            fields.setdefault(key >> 3, []).append(value)
+        return fields
+
+    def _read_pbf_header(self, file_path):
+        """Read the replication timestamp and sequence of the OSMHeader of a PBF file.
+
+        Only the first blob of the file is read and decompressed.
+
+        :return: Timestamp and sequence, None if they are not in the header
+        :rtype: (str, int)
+        """
+        with open(file_path, 'rb') as pbf_file:
+            header_size = int.from_bytes(pbf_file.read(4), 'big')
+            blob_header = self._read_protobuf(pbf_file.read(header_size))
+            if blob_header[1][0] != b'OSMHeader':
+                raise ValueError('%s does not start with an OSMHeader' % file_path)
+            blob = self._read_protobuf(pbf_file.read(blob_header[3][0]))
+        if 1 in blob:
+            header_block = blob[1][0]
+        elif 3 in blob:
+            header_block = decompress(blob[3][0])
+        else:
+            raise ValueError('The OSMHeader of %s is not compressed with zlib' % file_path)
+        header_block = self._read_protobuf(header_block)
+
+        timestamp = None
+        sequence = None
+        if 32 in header_block:
+            timestamp = datetime.fromtimestamp(
+                header_block[32][0], timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        if 33 in header_block:
+            sequence = header_block[33][0]
+        return timestamp, sequence
+
+    def _pbf_timestamp(self):
+        """Timestamp of the PBF file, cached in the manifest with the size and mtime of the file."""
+        file_stat = stat(self.osm_file)
+        fingerprint = {
+            'file': self.osm_file,
+            'size': file_stat.st_size,
+            'mtime': file_stat.st_mtime
+        }
+        manifest = self.open_manifest()
+        cache = manifest.execute(
+            "SELECT value FROM manifest_meta WHERE key = 'pbf_header'").fetchone()
+        if cache:
+            cache = json.loads(cache[0])
+            if cache['fingerprint'] == fingerprint:
+                return cache['timestamp']
+
+        try:
+            timestamp, sequence = self._read_pbf_header(self.osm_file)
+        except (IOError, KeyError, IndexError, ValueError, ZlibError) as e:
+            self.info('The header of %s can not be read : %s' % (self.osm_file, e))
+            timestamp, sequence = None, None
+        if timestamp is None:
+            # Fall back to osmconvert.
+            command = ['osmconvert', self.osm_file, '--out-timestamp']
+            processus = Popen(
+                command, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+            timestamp, err = processus.communicate()
+
+            # Remove new line
+            timestamp = timestamp.strip().decode('utf-8').replace('\\', '')
+        else:
+            self.info('Replication sequence of the original file : %s' % sequence)
+
+        if not timestamp:
+            # Do not cache a failed read, it is retried on the next run.
+            self.info('The timestamp of %s can not be read' % self.osm_file)
+            return timestamp
+
+        with manifest:
+            manifest.execute(
+                "INSERT OR REPLACE INTO manifest_meta (key, value) VALUES ('pbf_header', ?)",
+                (json.dumps({
+                    'fingerprint': fingerprint,
+                    'timestamp': timestamp,
+                    'sequence': sequence
+                }),))
+        return timestamp
+
+    def _fetch_replication_file(self, path):
+        """Get the content of a file of the replication.
+
+        BASE_URL can be an http(s) URL, which is fetched with a keep-alive
+        connection per thread, or a local folder.
+        """
+        base_url = urlsplit(self.default['BASE_URL'])
+        if base_url.scheme not in ('http', 'https'):
+            with open(join(unquote(base_url.path), self.default['DIFF'], path), 'rb') as f:
+                return f.read()
+
+        url_path = '%s/%s/%s' % (base_url.path.rstrip('/'), self.default['DIFF'], path)
+        for attempt in range(3):
+            connection = getattr(self.replication_connection, 'connection', None)
+            if connection is None or attempt > 0:
+                if connection is not None:
+                    connection.close()
+                if base_url.scheme == 'https':
+                    connection = HTTPSConnection(base_url.netloc, timeout=60)
+                else:
+                    connection = HTTPConnection(base_url.netloc, timeout=60)
+                self.replication_connection.connection = connection
+            try:
+                connection.request('GET', url_path)
+                response = connection.getresponse()
+                content = response.read()
+            except (HTTPException, OSError) as e:
+                self.info('Request %s failed : %s' % (url_path, e))
+                sleep(2.0)
+                continue
+            if response.status != 200:
+                raise IOError('%s returns %s' % (url_path, response.status))
+            return content
+        raise IOError('%s can not be fetched' % url_path)
+
+    @staticmethod
+    def _sequence_path(sequence):
+        return '%03d/%03d/%03d' % (sequence // 1000000, sequence // 1000 % 1000, sequence % 1000)
+
+    def _replication_state(self, sequence=None):
+        """Read a state.txt of the replication, the latest one if sequence is None.
+
+        :return: Sequence number and timestamp of the state
+        :rtype: (int, str)
+        """
+        if sequence is None:
+            path = 'state.txt'
+        else:
+            path = '%s.state.txt' % self._sequence_path(sequence)
+        state = {}
+        for line in self._fetch_replication_file(path).decode('utf-8').splitlines():
+            if '=' in line and not line.startswith('#'):
+                key, value = line.split('=', 1)
+                state[key.strip()] = value.strip().replace('\\', '')
+        return int(state['sequenceNumber']), state['timestamp']
+
+    def _find_replication_sequence(self, timestamp):
+        """Find the latest sequence of the replication not newer than timestamp."""
+        latest_sequence, latest_timestamp = self._replication_state()
+        if latest_timestamp <= timestamp:
+            return latest_sequence
+
+        # Guess from the interval, then bisect on the timestamps of the states.
+        elapsed = (datetime.strptime(latest_timestamp, '%Y-%m-%dT%H:%M:%SZ') -
+                   datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ')).total_seconds()
+        step = max(int(elapsed // self.replication_interval[self.default['DIFF']]), 1)
+        upper = latest_sequence
+        lower = max(latest_sequence - step, 0)
+        while lower > 0 and self._replication_state(lower)[1] > timestamp:
+            upper = lower
+            step *= 2
+            lower = max(latest_sequence - step, 0)
+        while upper - lower > 1:
+            middle = (lower + upper) // 2
+            if self._replication_state(middle)[1] <= timestamp:
+                lower = middle
+            else:
+                upper = middle
+        return lower
+
+    def _fetch_replication_diff(self, sequence):
+        """Download and verify the diff of a sequence, without decompressing it to disk."""
+        start = monotonic()
+        content = self._fetch_replication_file('%s.osc.gz' % self._sequence_path(sequence))
+        state_sequence, timestamp = self._replication_state(sequence)
+        if state_sequence != sequence:
+            raise ValueError('The state of %s is for the sequence %s' % (sequence, state_sequence))
+        decompressor = decompressobj(16 + MAX_WBITS)
+        for index in range(0, len(content), 1048576):
+            decompressor.decompress(content[index:index + 1048576], 1048576)
+            while decompressor.unconsumed_tail:
+                decompressor.decompress(decompressor.unconsumed_tail, 1048576)
+        decompressor.flush()
+        if not decompressor.eof:
+            raise ValueError('The diff of %s is truncated' % sequence)
+        self.metrics.observe('docker_osm_diff_download_seconds', monotonic() - start)
+        return content, timestamp
+
+    def download_replication(self):
+        """Infinite loop to download the diff files of the replication by sequence."""
+        meta_key = 'replication_sequence_%s' % self.default['DIFF']
+        manifest = self.open_manifest()
+        executor = ThreadPoolExecutor(max_workers=int(self.default['REPLICATION_WORKERS']))
+        while True:
+            self._wait_for_queue()
+            start = monotonic()
+            try:
+                timestamp = self._check_latest_timestamp()
+                sequence = manifest.execute(
+                    'SELECT value FROM manifest_meta WHERE key = ?', (meta_key,)).fetchone()
+                if sequence:
+                    sequence = int(sequence[0])
+                else:
+                    sequence = self._find_replication_sequence(timestamp)
+                    self.info('Replication sequence of %s : %s' % (timestamp, sequence))
+                latest_sequence, latest_timestamp = self._replication_state()
+
+                depth = manifest.execute(
+                    'SELECT COUNT(*) FROM diffs WHERE imported_at IS NULL').fetchone()[0]
+                count = max(int(self.default['QUEUE_MAX_DEPTH']) - depth, 1)
+                sequences = range(sequence + 1, min(latest_sequence, sequence + count) + 1)
+                if len(sequences) == 0:
+                    self.info('The database is already up-to-date : %s' % latest_timestamp)
+
+                # The next sequences are downloaded concurrently, but written in order.
+                for sequence, (content, sequence_timestamp) in zip(
+                        sequences, executor.map(self._fetch_replication_diff, sequences)):
+                    file_name = '%s->-%s.osc.gz' % (timestamp, sequence_timestamp)
+                    partial_file_path = join(self.default['IMPORT_QUEUE'], '.' + file_name)
+                    with open(partial_file_path, 'wb') as diff_file:
+                        diff_file.write(content)
+                    self.queue_diff(file_name, partial_file_path, (meta_key, str(sequence)))
+                    self.info('Creating diff successful : %s (sequence %s)' % (file_name, sequence))
+                    timestamp = sequence_timestamp
+            except (HTTPException, IOError, OSError, ValueError, KeyError, ZlibError) as e:
+                self.info('An error occured in the replication. Let\'s try again : %s' % e)
+                self.info('Sleeping for 2 seconds.')
+                sleep(2.0)
+                continue
+
+            # Catch up without sleeping, else wait for the next sequence.
+            if len(sequences) == 0 or sequences[-1] == latest_sequence:
+                wait = float(self.default['TIME']) - (monotonic() - start)
+                if wait > 0:
+                    self.info('Sleeping for %.0f seconds.' % wait)
+                    sleep(wait)
+
     def download(self):
         """Infinite loop to download diff files on a regular interval."""
+        if self.default['REPLICATION_CLIENT'] == 'native':
+            self.download_replication()
+            return
         while True:
+            # Do not download more while the importer is too far behind.
+            self._wait_for_queue()
+            start = monotonic()
             timestamp = self._check_latest_timestamp()
 
             # Save time
@@ -135,9 +561,10 @@ class Downloader(object):
             self.info('Old time     : %s' % timestamp)
             self.info('Current time : %s' % current_time)
 
-            # Destination
+            # Destination, written as a hidden file then renamed when complete
+            # so the importer never takes a partial diff.
             file_name = '%s->-%s.osc.gz' % (timestamp, current_time)
-            file_path = join(self.default['IMPORT_QUEUE'], file_name)
+            partial_file_path = join(self.default['IMPORT_QUEUE'], '.' + file_name)
 
             # Command
             command = ['osmupdate', '-v']
@@ -147,23 +574,38 @@ class Downloader(object):
             command += ['--compression-level=' + self.default['COMPRESSION_LEVEL']]
             command += ['--base-url=' + self.default['BASE_URL']]
             command.append(timestamp)
-            command.append(file_path)
+            command.append(partial_file_path)
 
             self.info(' '.join(command))
-            if call(command) != 0:
-                self.info('An error occured in osmupdate. Let\'s try again.')
+            download_start = monotonic()
+            result = call(command)
+            if result != 0 or not exists(partial_file_path):
+                if exists(partial_file_path):
+                    remove(partial_file_path)
+                if result == 21:
+                    self.info('The database is already up-to-date.')
+                else:
+                    self.info('An error occured in osmupdate. Let\'s try again.')
                 # Sleep less.
                 self.info('Sleeping for 2 seconds.')
                 sleep(2.0)
             else:
-                # Everything was fine, let's sleeping.
+                self.metrics.observe('docker_osm_diff_download_seconds', monotonic() - download_start)
+                self.queue_diff(file_name, partial_file_path)
                 self.info('Creating diff successful : %s' % file_name)
-                self.info('Sleeping for %s seconds.' % self.default['TIME'])
-                sleep(float(self.default['TIME']))
+
+                # Everything was fine, let's sleeping until the next interval.
+                # The importer applies this diff in the meantime.
+                wait = float(self.default['TIME']) - (monotonic() - start)
+                if wait > 0:
+                    self.info('Sleeping for %.0f seconds.' % wait)
+                    sleep(wait)
 
 
 if __name__ == '__main__':
     downloader = Downloader()
     downloader.overwrite_environment()
     downloader.check_settings()
+    downloader.start_metrics()
+    downloader.reconcile_manifest()
     downloader.download()
@@ -0,0 +1,125 @@
+import zlib
+from datetime import datetime, timedelta
+
+import pytest
+
+from download import Downloader
+
+
+def varint(value):
+    data = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            data.append(byte | 0x80)
+        else:
+            data.append(byte)
+            return bytes(data)
+
+
+def field(number, value):
+    """Encode a protobuf field, a varint for an integer and length delimited for bytes."""
+    if isinstance(value, int):
+        return varint(number << 3) + varint(value)
+    return varint(number << 3 | 2) + varint(len(value)) + value
+
+
+def write_pbf(path, header_block, compress=True, blob_type=b'OSMHeader'):
+    if compress:
+        blob = field(2, len(header_block)) + field(3, zlib.compress(header_block))
+    else:
+        blob = field(1, header_block)
+    blob_header = field(1, blob_type) + field(3, len(blob))
+    with open(path, 'wb') as pbf:
+        pbf.write(len(blob_header).to_bytes(4, 'big') + blob_header + blob)
+
+
+def test_read_varint():
+    assert Downloader._read_varint(varint(1), 0) == (1, 1)
+    assert Downloader._read_varint(varint(300), 0) == (300, 2)
+    assert Downloader._read_varint(b'\x00' + varint(1600000000), 1) == (1600000000, 6)
+
+
+def test_read_protobuf():
+    data = field(1, b'OSMHeader') + field(3, 42) + field(1, b'again')
+    assert Downloader()._read_protobuf(data) == {1: [b'OSMHeader', b'again'], 3: [42]}
+
+
+def test_read_protobuf_skips_fixed_sizes():
+    data = varint(2 << 3 | 1) + b'\x01' * 8 + varint(4 << 3 | 5) + b'\x02' * 4 + field(5, 7)
+    assert Downloader()._read_protobuf(data) == {2: [b'\x01' * 8], 4: [b'\x02' * 4], 5: [7]}
+
+
+def test_read_protobuf_unsupported_wire_type():
+    with pytest.raises(ValueError):
+        Downloader()._read_protobuf(varint(1 << 3 | 3))
+
+
+@pytest.mark.parametrize('compress', [True, False])
+def test_read_pbf_header(tmpdir, compress):
+    path = str(tmpdir.join('country.osm.pbf'))
+    write_pbf(path, field(4, b'OsmSchema-V0.6') + field(32, 1577836800) + field(33, 3800000), compress)
+    assert Downloader()._read_pbf_header(path) == ('2020-01-01T00:00:00Z', 3800000)
+
+
+def test_read_pbf_header_without_replication(tmpdir):
+    path = str(tmpdir.join('country.osm.pbf'))
+    write_pbf(path, field(4, b'OsmSchema-V0.6'))
+    assert Downloader()._read_pbf_header(path) == (None, None)
+
+
+def test_read_pbf_header_not_an_osm_header(tmpdir):
+    path = str(tmpdir.join('country.osm.pbf'))
+    write_pbf(path, field(4, b'OsmSchema-V0.6'), blob_type=b'OSMData')
+    with pytest.raises(ValueError):
+        Downloader()._read_pbf_header(path)
+
+
+def test_sequence_path():
+    assert Downloader._sequence_path(5) == '000/000/005'
+    assert Downloader._sequence_path(4123456) == '004/123/456'
+
+
+class ReplicationDownloader(Downloader):
+    """Downloader on a replication of a state a minute, with some gaps."""
+
+    start = datetime(2020, 1, 1)
+
+    def __init__(self, latest_sequence):
+        super(ReplicationDownloader, self).__init__()
+        self.default['DIFF'] = 'minute'
+        self.latest_sequence = latest_sequence
+        self.requested = []
+
+    def timestamp(self, sequence):
+        # Every hundredth state is late by 30 minutes, so the guess is not exact.
+        minutes = sequence + 30 * (sequence // 100)
+        return (self.start + timedelta(minutes=minutes)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    def _replication_state(self, sequence=None):
+        if sequence is None:
+            sequence = self.latest_sequence
+        self.requested.append(sequence)
+        return sequence, self.timestamp(sequence)
+
+
+@pytest.mark.parametrize('sequence', [1, 99, 100, 250, 999, 1000])
+def test_find_replication_sequence(sequence):
+    downloader = ReplicationDownloader(1000)
+    assert downloader._find_replication_sequence(downloader.timestamp(sequence)) == sequence
+    # A timestamp between two states is in the older one.
+    between = datetime.strptime(downloader.timestamp(sequence), '%Y-%m-%dT%H:%M:%SZ') + timedelta(seconds=30)
+    assert downloader._find_replication_sequence(between.strftime('%Y-%m-%dT%H:%M:%SZ')) == sequence
+
+
+def test_find_replication_sequence_newer_than_latest():
+    downloader = ReplicationDownloader(1000)
+    assert downloader._find_replication_sequence('2030-01-01T00:00:00Z') == 1000
+    assert downloader.requested == [1000]
+
+
+def test_find_replication_sequence_bisects():
+    downloader = ReplicationDownloader(1000000)
+    downloader._find_replication_sequence(downloader.timestamp(123456))
+    assert len(downloader.requested) < 50
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+/***************************************************************************
+                              Docker-OSM
+                    Generate materialized_views.sql from scale_bands.yml.
+ ***************************************************************************/
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from argparse import ArgumentParser
+from os.path import abspath, dirname, join
+
+from yaml import safe_load
+
+SETTINGS = dirname(abspath(__file__))
+
+# Schema, table of the bands and the functions keeping them up to date.
+LIBRARY = '''-- The scale bands of the OSM layers are tables holding the rows of an OSM table which
+-- match a predicate. They are kept up to date by statement triggers on the OSM tables, so
+-- an imposm diff only copies the changed rows and the readers of the bands are never blocked.
+CREATE TABLE materialized_views.bands (
+    band_name name PRIMARY KEY,
+    source regclass NOT NULL,
+    predicate text NOT NULL,
+    columns text NOT NULL
+);
+
+-- Create a band of an OSM table and its indexes.
+-- The band has a unique index on id, a GiST index on geometry and an index on each column of
+-- indexes. A clustered band is ordered by the geohash of its geometry, so the rows of a tile
+-- are read from a few pages; the rows added later by the diffs are appended.
+CREATE FUNCTION materialized_views.create_band(
+    band_name name, source regclass, predicate text, indexes text[] DEFAULT '{}', clustered boolean DEFAULT false)
+RETURNS void AS $$
+DECLARE
+    columns text;
+    index_column text;
+    has_geometry boolean;
+BEGIN
+    EXECUTE format(
+        'CREATE TABLE materialized_views.%I AS SELECT * FROM %s WHERE %s', band_name, source, predicate);
+    EXECUTE format('CREATE UNIQUE INDEX ON materialized_views.%I (id)', band_name);
+
+    SELECT EXISTS (
+        SELECT 1 FROM pg_attribute
+        WHERE attrelid = source AND attname = 'geometry' AND NOT attisdropped) INTO has_geometry;
+    IF has_geometry THEN
+        EXECUTE format('CREATE INDEX ON materialized_views.%I USING gist (geometry)', band_name);
+    END IF;
+    FOREACH index_column IN ARRAY indexes LOOP
+        EXECUTE format('CREATE INDEX ON materialized_views.%I (%I)', band_name, index_column);
+    END LOOP;
+    IF clustered AND has_geometry THEN
+        EXECUTE format(
+            'CREATE INDEX %I ON materialized_views.%I '
+            '(ST_GeoHash(ST_Transform(ST_Centroid(geometry), 4326), 10))',
+            band_name || '_geohash', band_name);
+        EXECUTE format(
+            'CLUSTER materialized_views.%I USING %I', band_name, band_name || '_geohash');
+    END IF;
+    EXECUTE format('ANALYZE materialized_views.%I', band_name);
+
+    -- The columns are listed, so the columns added later to the OSM table are ignored.
+    SELECT string_agg(quote_ident(attname), ', ' ORDER BY attnum) INTO columns
+    FROM pg_attribute
+    WHERE attrelid = format('materialized_views.%I', band_name)::regclass AND attnum > 0 AND NOT attisdropped;
+    INSERT INTO materialized_views.bands VALUES (band_name, source, predicate, columns);
+END;
+$$ LANGUAGE plpgsql;
+
+-- Create the triggers of an OSM table applying its changed rows to its bands.
+-- The trigger function is written once the bands of the table are created, with a static
+-- statement for each band, so a diff runs no dynamic SQL and no lookup of the bands.
+CREATE FUNCTION materialized_views.create_band_triggers(source regclass) RETURNS void AS $$
+DECLARE
+    sync_function text;
+    deletes text;
+    inserts text;
+BEGIN
+    sync_function := format(
+        'materialized_views.%I', 'sync_' || (SELECT relname FROM pg_class WHERE oid = source));
+    SELECT
+        string_agg(format(
+            '        DELETE FROM materialized_views.%I WHERE id IN (SELECT id FROM old_rows);',
+            band_name), E'\\n' ORDER BY band_name),
+        string_agg(format(
+            '        INSERT INTO materialized_views.%I (%s) SELECT %s FROM new_rows WHERE %s;',
+            band_name, columns, columns, predicate), E'\\n' ORDER BY band_name)
+    INTO deletes, inserts
+    FROM materialized_views.bands WHERE bands.source = create_band_triggers.source;
+
+    EXECUTE format('CREATE OR REPLACE FUNCTION %s() RETURNS trigger AS $sync$
+BEGIN
+    IF TG_OP IN (''UPDATE'', ''DELETE'') THEN
+%s
+    END IF;
+    IF TG_OP IN (''INSERT'', ''UPDATE'') THEN
+%s
+    END IF;
+    RETURN NULL;
+END;
+$sync$ LANGUAGE plpgsql', sync_function, deletes, inserts);
+
+    EXECUTE format('DROP TRIGGER IF EXISTS materialized_views_insert ON %s', source);
+    EXECUTE format('DROP TRIGGER IF EXISTS materialized_views_update ON %s', source);
+    EXECUTE format('DROP TRIGGER IF EXISTS materialized_views_delete ON %s', source);
+    EXECUTE format(
+        'CREATE TRIGGER materialized_views_insert AFTER INSERT ON %s '
+        'REFERENCING NEW TABLE AS new_rows '
+        'FOR EACH STATEMENT EXECUTE PROCEDURE %s()', source, sync_function);
+    EXECUTE format(
+        'CREATE TRIGGER materialized_views_update AFTER UPDATE ON %s '
+        'REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows '
+        'FOR EACH STATEMENT EXECUTE PROCEDURE %s()', source, sync_function);
+    EXECUTE format(
+        'CREATE TRIGGER materialized_views_delete AFTER DELETE ON %s '
+        'REFERENCING OLD TABLE AS old_rows '
+        'FOR EACH STATEMENT EXECUTE PROCEDURE %s()', source, sync_function);
+END;
+$$ LANGUAGE plpgsql;
+'''
+
+
+def quote_literal(value):
+    return "'%s'" % value.replace("'", "''")
+
+
+def generate(scale_bands):
+    """Return the SQL creating the scale bands of the OSM layers.
+
+    :param scale_bands: Content of scale_bands.yml
+    :type scale_bands: dict
+
+    :return: SQL script
+    :rtype: str
+    """
+    schema = scale_bands.get('schema', 'osm')
+    owner = scale_bands.get('owner', 'docker')
+    lines = [
+        '-- Generated by materialized_views.py from scale_bands.yml, do not edit.',
+        # The importer checks them against DBSCHEMA_PRODUCTION and POSTGRES_USER.
+        '-- Schema: %s' % schema,
+        '-- Owner: %s' % owner,
+        '',
+        '-- Drop the materialized_views schema if it exists.',
+        'DROP SCHEMA IF EXISTS materialized_views CASCADE;',
+        '',
+        '',
+        '-- Create the materialized_views schema. ',
+        'CREATE SCHEMA materialized_views;',
+        '',
+        'ALTER SCHEMA materialized_views OWNER TO %s;' % owner,
+        '',
+        '',
+        LIBRARY.rstrip('\n')
+    ]
+    for layer, layer_data in scale_bands['layers'].items():
+        indexes = ', '.join(quote_literal(column) for column in layer_data.get('indexes', []))
+        clustered = layer_data.get('cluster', scale_bands.get('cluster', False))
+        lines.extend(['', '', '-- Create the bands of the %s layer.' % layer])
+        for band_name, predicate in layer_data['bands'].items():
+            if '$$' in predicate:
+                raise ValueError('The predicate of %s can not contain $$' % band_name)
+            lines.append(
+                'SELECT materialized_views.create_band(%s, %s, $$%s$$, ARRAY[%s]::text[], %s);' % (
+                    quote_literal(band_name), quote_literal('%s.%s' % (schema, layer)), predicate, indexes,
+                    'true' if clustered else 'false'))
+        lines.append('SELECT materialized_views.create_band_triggers(%s);' % quote_literal('%s.%s' % (schema, layer)))
+    return '\n'.join(lines) + '\n'
+
+
+if __name__ == '__main__':
+    arguments = ArgumentParser(description='Generate materialized_views.sql from scale_bands.yml.')
+    arguments.add_argument('--config', default=join(SETTINGS, 'scale_bands.yml'))
+    arguments.add_argument('--output', default=join(SETTINGS, 'materialized_views.sql'))
+    options = arguments.parse_args()
+    with open(options.config) as config:
+        sql = generate(safe_load(config))
+    with open(options.output, 'w') as output:
+        output.write(sql)
+    print('%s written' % options.output)
@@ -1,3 +1,7 @@
+-- Generated by materialized_views.py from scale_bands.yml, do not edit.
+-- Schema: osm
+-- Owner: docker
+
 -- Drop the materialized_views schema if it exists.
 DROP SCHEMA IF EXISTS materialized_views CASCADE;
 
@@ -8,77 +12,132 @@ CREATE SCHEMA materialized_views;
 ALTER SCHEMA materialized_views OWNER TO docker;
 
 
--- Create materialized views for the osm_admin layer. 
-CREATE MATERIALIZED VIEW materialized_views.osm_admin_500m_8m AS 
-SELECT * 
-FROM osm.osm_admin
-WHERE admin_level = 2;
-
-CREATE MATERIALIZED VIEW materialized_views.osm_admin_8m_2m AS 
-SELECT * 
-FROM osm.osm_admin
-WHERE admin_level = 3;
-
-CREATE MATERIALIZED VIEW materialized_views.osm_admin_2m_500k AS 
-SELECT * 
-FROM osm.osm_admin
-WHERE admin_level = 4;
-
-CREATE MATERIALIZED VIEW materialized_views.osm_admin_500k_0 AS 
-SELECT * 
-FROM osm.osm_admin
-WHERE admin_level > 4;
-
-
--- Create materialized views for the osm_roads layer. 
-CREATE MATERIALIZED VIEW materialized_views.osm_roads_15m AS 
-SELECT *
-FROM osm.osm_roads
-WHERE type SIMILAR TO '%(trunk|primary)%';
-
-CREATE MATERIALIZED VIEW materialized_views.osm_roads_1m AS 
-SELECT * 
-FROM osm.osm_roads
-WHERE type SIMILAR TO '%(secondary)%';
-
-CREATE MATERIALIZED VIEW materialized_views.osm_roads_500k AS 
-SELECT * 
-FROM osm.osm_roads
-WHERE type SIMILAR TO '%(tertiary)%';
-
-CREATE MATERIALIZED VIEW materialized_views.osm_roads_15k AS 
-SELECT * 
-FROM osm.osm_roads
-WHERE type NOT LIKE ALL(ARRAY['trunk', 'trunk_link', 'primary', 'primary_link',  'secondary', 'secondary_link', 'tertiary', 'tertiary_link']);
-
-
--- Create materialized views for the osm_places layer.
-CREATE MATERIALIZED VIEW materialized_views.osm_places_8m_2m AS 
-SELECT * 
-FROM osm.osm_places
-WHERE place IN ('state', 'region');
-
-CREATE MATERIALIZED VIEW materialized_views.osm_places_2m_500k AS 
-SELECT * 
-FROM osm.osm_places
-WHERE place = 'county';
-
-CREATE MATERIALIZED VIEW materialized_views.osm_places_2m_150k AS 
-SELECT * 
-FROM osm.osm_places
-WHERE place = 'city';
-
-CREATE MATERIALIZED VIEW materialized_views.osm_places_150k AS 
-SELECT * 
-FROM osm.osm_places
-WHERE place = 'town';
-
-CREATE MATERIALIZED VIEW materialized_views.osm_places_70k AS 
-SELECT * 
-FROM osm.osm_places
-WHERE place IN ('suburb', 'village', 'hamlet') ;
-
-CREATE MATERIALIZED VIEW materialized_views.osm_places_35k AS 
-SELECT * 
-FROM osm.osm_places
-WHERE place = 'locality';
\ No newline at end of file
+-- The scale bands of the OSM layers are tables holding the rows of an OSM table which
+-- match a predicate. They are kept up to date by statement triggers on the OSM tables, so
+-- an imposm diff only copies the changed rows and the readers of the bands are never blocked.
+CREATE TABLE materialized_views.bands (
+    band_name name PRIMARY KEY,
+    source regclass NOT NULL,
+    predicate text NOT NULL,
+    columns text NOT NULL
+);
+
+-- Create a band of an OSM table and its indexes.
+-- The band has a unique index on id, a GiST index on geometry and an index on each column of
+-- indexes. A clustered band is ordered by the geohash of its geometry, so the rows of a tile
+-- are read from a few pages; the rows added later by the diffs are appended.
+CREATE FUNCTION materialized_views.create_band(
+    band_name name, source regclass, predicate text, indexes text[] DEFAULT '{}', clustered boolean DEFAULT false)
+RETURNS void AS $$
+DECLARE
+    columns text;
+    index_column text;
+    has_geometry boolean;
+BEGIN
+    EXECUTE format(
+        'CREATE TABLE materialized_views.%I AS SELECT * FROM %s WHERE %s', band_name, source, predicate);
+    EXECUTE format('CREATE UNIQUE INDEX ON materialized_views.%I (id)', band_name);
+
+    SELECT EXISTS (
+        SELECT 1 FROM pg_attribute
+        WHERE attrelid = source AND attname = 'geometry' AND NOT attisdropped) INTO has_geometry;
+    IF has_geometry THEN
+        EXECUTE format('CREATE INDEX ON materialized_views.%I USING gist (geometry)', band_name);
+    END IF;
+    FOREACH index_column IN ARRAY indexes LOOP
+        EXECUTE format('CREATE INDEX ON materialized_views.%I (%I)', band_name, index_column);
+    END LOOP;
+    IF clustered AND has_geometry THEN
+        EXECUTE format(
+            'CREATE INDEX %I ON materialized_views.%I '
+            '(ST_GeoHash(ST_Transform(ST_Centroid(geometry), 4326), 10))',
+            band_name || '_geohash', band_name);
+        EXECUTE format(
+            'CLUSTER materialized_views.%I USING %I', band_name, band_name || '_geohash');
+    END IF;
+    EXECUTE format('ANALYZE materialized_views.%I', band_name);
+
+    -- The columns are listed, so the columns added later to the OSM table are ignored.
+    SELECT string_agg(quote_ident(attname), ', ' ORDER BY attnum) INTO columns
+    FROM pg_attribute
+    WHERE attrelid = format('materialized_views.%I', band_name)::regclass AND attnum > 0 AND NOT attisdropped;
+    INSERT INTO materialized_views.bands VALUES (band_name, source, predicate, columns);
+END;
+$$ LANGUAGE plpgsql;
+
+-- Create the triggers of an OSM table applying its changed rows to its bands.
+-- The trigger function is written once the bands of the table are created, with a static
+-- statement for each band, so a diff runs no dynamic SQL and no lookup of the bands.
+CREATE FUNCTION materialized_views.create_band_triggers(source regclass) RETURNS void AS $$
+DECLARE
+    sync_function text;
+    deletes text;
+    inserts text;
+BEGIN
+    sync_function := format(
+        'materialized_views.%I', 'sync_' || (SELECT relname FROM pg_class WHERE oid = source));
+    SELECT
+        string_agg(format(
+            '        DELETE FROM materialized_views.%I WHERE id IN (SELECT id FROM old_rows);',
+            band_name), E'\n' ORDER BY band_name),
+        string_agg(format(
+            '        INSERT INTO materialized_views.%I (%s) SELECT %s FROM new_rows WHERE %s;',
+            band_name, columns, columns, predicate), E'\n' ORDER BY band_name)
+    INTO deletes, inserts
+    FROM materialized_views.bands WHERE bands.source = create_band_triggers.source;
+
+    EXECUTE format('CREATE OR REPLACE FUNCTION %s() RETURNS trigger AS $sync$
+BEGIN
+    IF TG_OP IN (''UPDATE'', ''DELETE'') THEN
+%s
+    END IF;
+    IF TG_OP IN (''INSERT'', ''UPDATE'') THEN
+%s
+    END IF;
+    RETURN NULL;
+END;
+$sync$ LANGUAGE plpgsql', sync_function, deletes, inserts);
+
+    EXECUTE format('DROP TRIGGER IF EXISTS materialized_views_insert ON %s', source);
+    EXECUTE format('DROP TRIGGER IF EXISTS materialized_views_update ON %s', source);
+    EXECUTE format('DROP TRIGGER IF EXISTS materialized_views_delete ON %s', source);
+    EXECUTE format(
+        'CREATE TRIGGER materialized_views_insert AFTER INSERT ON %s '
+        'REFERENCING NEW TABLE AS new_rows '
+        'FOR EACH STATEMENT EXECUTE PROCEDURE %s()', source, sync_function);
+    EXECUTE format(
+        'CREATE TRIGGER materialized_views_update AFTER UPDATE ON %s '
+        'REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows '
+        'FOR EACH STATEMENT EXECUTE PROCEDURE %s()', source, sync_function);
+    EXECUTE format(
+        'CREATE TRIGGER materialized_views_delete AFTER DELETE ON %s '
+        'REFERENCING OLD TABLE AS old_rows '
+        'FOR EACH STATEMENT EXECUTE PROCEDURE %s()', source, sync_function);
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Create the bands of the osm_admin layer.
+SELECT materialized_views.create_band('osm_admin_500m_8m', 'osm.osm_admin', $$admin_level = 2$$, ARRAY['admin_level']::text[], true);
+SELECT materialized_views.create_band('osm_admin_8m_2m', 'osm.osm_admin', $$admin_level = 3$$, ARRAY['admin_level']::text[], true);
+SELECT materialized_views.create_band('osm_admin_2m_500k', 'osm.osm_admin', $$admin_level = 4$$, ARRAY['admin_level']::text[], true);
+SELECT materialized_views.create_band('osm_admin_500k_0', 'osm.osm_admin', $$admin_level > 4$$, ARRAY['admin_level']::text[], true);
+SELECT materialized_views.create_band_triggers('osm.osm_admin');
+
+
+-- Create the bands of the osm_roads layer.
+SELECT materialized_views.create_band('osm_roads_15m', 'osm.osm_roads', $$type SIMILAR TO '%(trunk|primary)%'$$, ARRAY['type']::text[], true);
+SELECT materialized_views.create_band('osm_roads_1m', 'osm.osm_roads', $$type SIMILAR TO '%(secondary)%'$$, ARRAY['type']::text[], true);
+SELECT materialized_views.create_band('osm_roads_500k', 'osm.osm_roads', $$type SIMILAR TO '%(tertiary)%'$$, ARRAY['type']::text[], true);
+SELECT materialized_views.create_band('osm_roads_15k', 'osm.osm_roads', $$type NOT LIKE ALL(ARRAY['trunk', 'trunk_link', 'primary', 'primary_link',  'secondary', 'secondary_link', 'tertiary', 'tertiary_link'])$$, ARRAY['type']::text[], true);
+SELECT materialized_views.create_band_triggers('osm.osm_roads');
+
+
+-- Create the bands of the osm_places layer.
+SELECT materialized_views.create_band('osm_places_8m_2m', 'osm.osm_places', $$place IN ('state', 'region')$$, ARRAY['place']::text[], true);
+SELECT materialized_views.create_band('osm_places_2m_500k', 'osm.osm_places', $$place = 'county'$$, ARRAY['place']::text[], true);
+SELECT materialized_views.create_band('osm_places_2m_150k', 'osm.osm_places', $$place = 'city'$$, ARRAY['place']::text[], true);
+SELECT materialized_views.create_band('osm_places_150k', 'osm.osm_places', $$place = 'town'$$, ARRAY['place']::text[], true);
+SELECT materialized_views.create_band('osm_places_70k', 'osm.osm_places', $$place IN ('suburb', 'village', 'hamlet')$$, ARRAY['place']::text[], true);
+SELECT materialized_views.create_band('osm_places_35k', 'osm.osm_places', $$place = 'locality'$$, ARRAY['place']::text[], true);
+SELECT materialized_views.create_band_triggers('osm.osm_places');